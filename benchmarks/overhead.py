@@ -0,0 +1,189 @@
+#!/usr/bin/env python
+"""Benchmark the wrapper's own overhead, with stub `singularity` and `sudo` on PATH.
+
+Measures, for synthetic descriptions of increasing size (many steps,
+substitutions and binds):
+
+* cli       - cold start of the CLI (`template`), and a full `build` and
+              `run --dry-run` of the smallest description
+* load      - Pipeline construction (YAML parsing, validation, plan compilation)
+* dry-run   - formatting all run steps in dry-run mode (excluding construction)
+* run       - a real run of trivial steps, sequentially (excluding construction)
+* dispatch  - per-step wrapper overhead of that run (its wall time minus
+              the steps' own, divided by the number of steps)
+
+Results are written as a step report, so two runs can be compared with
+
+    python -m singularity_pipeline compare old.json new.json --min-seconds 0
+
+Usage: python benchmarks/overhead.py [--sizes 10,100,1000,10000] [-o results.json]"""
+
+from __future__ import print_function
+
+import argparse
+import json
+import os
+import platform
+import shutil
+import subprocess
+import sys
+import tempfile
+import time
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, ROOT)
+
+from singularity_pipeline import __version__  # noqa: E402
+from singularity_pipeline.eprint import EPrint  # noqa: E402
+from singularity_pipeline.pipeline import Pipeline  # noqa: E402
+
+STUB_SINGULARITY = r'''#!/bin/sh
+# Benchmark stand-in for singularity: does no work
+case "$1" in
+  --version) echo "2.4.2-bench" ;;
+  build) for last; do :; done; n=$#; shift $((n - 2)); : > "$1" ;;
+esac
+exit 0
+'''
+
+STUB_SUDO = '''#!/bin/sh
+exec "$@"
+'''
+
+
+def make_description(steps, substitutions, binds, workdir):
+    """Generate a description with `steps` run steps in chains of 10, as a YAML string."""
+    import yaml
+
+    commands = []
+    for index in range(steps):
+        step = {
+            "name": "step{}".format(index),
+            "command": "{{exec}} true {{var{}}} {{var{}}}".format(index % substitutions, index * 7 % substitutions)
+        }
+        if index >= 10:
+            step["depends_on"] = "step{}".format(index - 10)
+        else:
+            step["depends_on"] = []
+        commands.append(step)
+
+    return yaml.safe_dump({
+        "format_version": 1,
+        "name": "bench{}".format(steps),
+        "version": 1,
+        "substitutions": dict(("var{}".format(i), "value{}".format(i)) for i in range(substitutions)),
+        "binds": ["{}/bind{}:/mnt/bind{}".format(workdir, i, i) for i in range(binds)],
+        "build": {"type": "build", "source": os.path.join(workdir, "Singularity")},
+        "run": {"commands": commands},
+        "test": {"test_files": [], "validate_commands": ["true"]}
+    }, default_flow_style=False)
+
+
+def timed(func, repeat, setup=None):
+    """Median wall time of repeat calls of func.
+
+    With setup, func(setup()) is timed, so setup is prepared afresh for each call outside the timing."""
+    times = []
+    for _ in range(repeat):
+        arguments = (setup(),) if setup else ()
+        started = time.time()
+        func(*arguments)
+        times.append(time.time() - started)
+    return sorted(times)[len(times) // 2]
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark singularity-pipeline's own overhead.")
+    parser.add_argument("--sizes", default="10,100,1000,10000",
+                        help="Comma-separated numbers of steps (default: %(default)s)")
+    parser.add_argument("--substitutions", type=int, default=200,
+                        help="Substitutions per description (default: %(default)s)")
+    parser.add_argument("--binds", type=int, default=50, help="Binds per description (default: %(default)s)")
+    parser.add_argument("--repeat", type=int, default=3, help="Repetitions; the median is kept (default: %(default)s)")
+    parser.add_argument("--run-max", type=int, default=1000,
+                        help="Largest description actually run (default: %(default)s)")
+    parser.add_argument("-o", "--output", help="Write results to this file (default: stdout)")
+    args = parser.parse_args()
+    sizes = [int(size) for size in args.sizes.split(",")]
+
+    workdir = tempfile.mkdtemp(prefix="pipeline-bench-")
+    results = []
+
+    def record(stage, size, seconds):
+        results.append({"stage": stage, "step": str(size), "command": stage, "exit_code": 0,
+                        "wall_time": round(seconds, 6)})
+        print("{:<9} {:>6} {:>12.6f}s".format(stage, size, seconds), file=sys.stderr)
+
+    try:
+        bin_dir = os.path.join(workdir, "bin")
+        os.makedirs(bin_dir)
+        for name, script in [("singularity", STUB_SINGULARITY), ("sudo", STUB_SUDO)]:
+            with open(os.path.join(bin_dir, name), "w") as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        for index in range(args.binds):
+            os.makedirs(os.path.join(workdir, "bind{}".format(index)))
+        with open(os.path.join(workdir, "Singularity"), "w") as f:
+            f.write("Bootstrap: docker\nFrom: alpine\n")
+
+        env = dict(os.environ, PATH=bin_dir + os.pathsep + os.environ.get("PATH", ""),
+                   PYTHONPATH=ROOT, XDG_CACHE_HOME=os.path.join(workdir, "cache"))
+        os.environ.update(env)
+
+        descriptions = {}
+        for size in sizes:
+            descriptions[size] = make_description(size, args.substitutions, args.binds, workdir)
+            with open(os.path.join(workdir, "bench{}.yaml".format(size)), "w") as f:
+                f.write(descriptions[size])
+
+        def cli(*arguments):
+            with open(os.devnull, "w") as devnull:
+                subprocess.check_call([sys.executable, "-m", "singularity_pipeline"] + list(arguments),
+                                      cwd=workdir, env=env, stdout=devnull, stderr=devnull)
+
+        smallest = "bench{}.yaml".format(min(sizes))
+        record("cli", "start", timed(lambda: cli("template"), args.repeat))
+        record("cli", "build", timed(lambda: cli("build", "-f", "-p", smallest, "-i", "cli.img"), args.repeat))
+        record("cli", "dry-run", timed(lambda: cli("run", "--dry-run", "-p", smallest, "-i", "cli.img"), args.repeat))
+
+        for size in sizes:
+            image = os.path.join(workdir, "bench{}.img".format(size))
+            open(image, "w").close()
+
+            def load(**options):
+                return Pipeline(descriptions[size], imagefile=image, eprint_instance=EPrint(quiet=True), **options)
+
+            record("load", size, timed(load, args.repeat))
+            record("dry-run", size, timed(Pipeline.run, args.repeat, setup=lambda: load(dry_run=True)))
+
+            if size <= args.run_max:
+                pipelines = []
+
+                def run(pipeline):
+                    pipeline.run()
+                    pipelines.append(pipeline)
+
+                run_time = timed(run, args.repeat, setup=lambda: load(report=True))
+                step_time = sum(step["wall_time"] for step in pipelines[-1].report.steps)
+                record("run", size, run_time)
+                record("dispatch", size, max(0, run_time - step_time) / size)
+    finally:
+        shutil.rmtree(workdir, ignore_errors=True)
+
+    report = {
+        "benchmark": "overhead",
+        "version": __version__,
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "created": time.time(),
+        "steps": results
+    }
+    if args.output:
+        with open(args.output, "w") as f:
+            json.dump(report, f, indent=1, sort_keys=True)
+    else:
+        print(json.dumps(report, indent=1, sort_keys=True))
+
+
+if __name__ == "__main__":
+    main()
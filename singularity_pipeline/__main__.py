@@ -1,10 +1,22 @@
-from .pipeline import Pipeline, ToolError, LoadError, check_singularity
-from .eprint import EPrint
+from .pipeline import Pipeline, ToolError, LoadError, FormatError, check_singularity
+from .executors import EXECUTORS
+from .store import ImageStore
+from .resources import parse_memory, format_memory
+from .eprint import EPrint, JsonLinesSink, open_event_stream
 from .templates import template_pipeline, template_version
+from .sweep import load_matrix
+from .report import load_report, compare_reports
+from .server import PipelineServer
+from .workspace import Workspace, find_descriptions
 from . import __version__
 
+import atexit
 import colorama
+import json
+import os
+import re
 import sys
+import time
 import argparse
 
 
@@ -13,46 +25,268 @@ def __main():
 
     Expects CLI arguments."""
     colorama.init()
-    eprint = EPrint()
-
     args = parse_args(sys.argv[1:])
 
+    sinks = []
+    if args.events:
+        try:
+            sinks.append(JsonLinesSink(open_event_stream(args.events)))
+        except (IOError, OSError, ValueError) as e:
+            EPrint().red("Cannot open event stream {}: {}".format(args.events, e))
+            sys.exit(1)
+    eprint = EPrint(sinks=sinks, quiet=args.quiet)
+    atexit.register(eprint.close)
+
     if args.command == "template":
         print(template_pipeline)
         exit(0)
 
+    if args.command == "compare":
+        sys.exit(compare(eprint, args.arguments, args.threshold, args.min_seconds))
+
+    store = None
+    try:
+        if args.store:
+            store = ImageStore(args.store, parse_memory(args.store_max_size) if args.store_max_size else None)
+    except (OSError, FormatError) as e:
+        eprint.red("Cannot use image store {}: {}".format(args.store, e))
+        sys.exit(1)
+
+    if args.command == "store":
+        sys.exit(store_command(eprint, store, args.arguments))
+
     try:
-        check_singularity()
+        if args.command not in ["check", "plan"]:  # Need no Singularity
+            check_singularity()
     except ToolError as e:
         eprint.red("Error when running `singularity`: {}".format(e.error))
         eprint.yellow("Check your Singularity installation!")
         sys.exit(1)
 
-    try:
+    if args.command == "serve":
+        server = PipelineServer(
+            args.socket,
+            lambda path, eprint: load_pipeline(path, eprint, args, store),
+            eprint, workers=args.workers, queue_size=args.queue_size, default_pipeline=args.pipeline
+        )
         try:
-            with open(args.pipeline) as f:
-                pipeline = Pipeline(f, imagefile=args.image, eprint_instance=eprint, dry_run=args.dry_run)
-        except IOError as e:
-            eprint.red("\nCannot open pipeline description {0}: {1}".format(args.pipeline, e.strerror))
-            raise LoadError()
+            server.serve()
+        except KeyboardInterrupt:
+            pass
+        except LoadError:
+            eprint.yellow("\nUnable to load pipeline description. Aborting.")
+            sys.exit(1)
+        sys.exit(0)
+
+    if len(args.pipelines) > 1 or args.workspace:
+        sys.exit(run_workspace(eprint, args, store))
+
+    try:
+        pipeline = load_pipeline(args.pipeline, eprint, args, store)
     except LoadError:
         eprint.yellow("\nUnable to load pipeline description. Aborting.")
         sys.exit(1)
 
+    eprint.event("pipeline.started", command=args.command, pipeline=pipeline.description.get("name"),
+                 version=pipeline.description.get("version"), image=pipeline.imagefile)
+    started = time.time()
+    status, error = "interrupted", None
     try:
-        if args.command == "build":
-            pipeline.build(force=args.force)
-        elif args.command == "run":
-            pipeline.run()
-        elif args.command == "test":
-            pipeline.test(force=args.force, skip_run=args.skip_run)
-        elif args.command == "check":
-            pipeline.check()
+        if args.command in ["build", "run", "test", "build-and-test", "check"]:
+            run_pipeline_command(pipeline, args)
+        elif args.command == "sweep":
+            if not args.matrix:
+                raise RuntimeError("sweep requires a substitution matrix (--matrix)")
+            pipeline.sweep(read_matrix(args.matrix), workers=args.workers)
+        elif args.command == "plan":
+            if args.json:
+                print(json.dumps(pipeline.plan.to_dict(), indent=1, sort_keys=True))
+            else:
+                print_plan(pipeline.plan)
         else:
             raise RuntimeError("Unknown command specified")
+        status = "ok"
     except RuntimeError as e:
+        status, error = "failed", str(e)
         eprint.red("ERROR: {}".format(e))
         sys.exit(1)
+    finally:
+        eprint.event("pipeline.finished", command=args.command, status=status, error=error,
+                     wall_time=round(time.time() - started, 4))
+        if args.report:
+            pipeline.report.save(args.report)
+            eprint.normal("Step report written to {}".format(args.report))
+
+
+def run_pipeline_command(pipeline, args):
+    """Run build, run, test, build-and-test or check on a pipeline.
+
+    Raises RuntimeError on failure."""
+    if args.command == "build":
+        pipeline.build(force=args.force)
+    elif args.command == "run":
+        pipeline.run()
+    elif args.command == "test":
+        pipeline.test(force=args.force, skip_run=args.skip_run, update_checksums=args.update_checksums)
+    elif args.command == "build-and-test":
+        pipeline.build_and_test(force=args.force, skip_run=args.skip_run, update_checksums=args.update_checksums)
+    elif args.command == "check":
+        rows = read_matrix(args.matrix) if args.matrix else []
+        pipeline.check(known=set(key for row in rows for key in row))
+    else:
+        raise RuntimeError("Unknown command specified")
+
+
+def run_workspace(eprint, args, store):
+    """Run a command on every pipeline of a workspace. Returns exit code."""
+    pipelines = args.pipelines
+
+    def action(pipeline):
+        try:
+            run_pipeline_command(pipeline, args)
+        finally:
+            if args.report:
+                path = report_path(args.report, pipeline.description.get("name"), len(pipelines))
+                pipeline.report.save(path)
+                pipeline.eprint.normal("Step report written to {}".format(path))
+
+    workspace = Workspace(pipelines, lambda path, ep: load_pipeline(path, ep, args, store), eprint,
+                          workers=args.workers)
+    results = workspace.run(args.command, action)
+    return 0 if all(result[args.command] == "ok" for result in results) else 1
+
+
+def report_path(path, name, count):
+    """Per-pipeline report file in a workspace: <stem>-<name><ext>."""
+    if count < 2 or not name:
+        return path
+    stem, extension = os.path.splitext(path)
+    return "{}-{}{}".format(stem, re.sub(r"[^A-Za-z0-9_.-]+", "_", str(name)), extension)
+
+
+def load_pipeline(path, eprint, args, store):
+    """Create a Pipeline from a description file with CLI options applied.
+
+    Raises LoadError if the description can't be opened or parsed."""
+    try:
+        with open(path) as f:
+            return Pipeline(
+                f, imagefile=args.image if path == args.pipeline else None, eprint_instance=eprint,
+                dry_run=args.dry_run, jobs=args.jobs,
+                check_mode=args.check_mode, rebuild_steps=args.rebuild_step, use_instance=args.instance,
+                report=bool(args.report), resume=args.resume, cpus=args.cpus, memory=args.memory,
+                executor=args.executor, batch_options=args.batch_options, store=store, scratch=args.scratch,
+                log_dir=args.log_dir, compress_logs=args.compress_logs, tail_lines=args.tail_lines,
+                prefix_output=args.prefix_output, sample_interval=args.sample_interval
+            )
+    except IOError as e:
+        eprint.red("\nCannot open pipeline description {0}: {1}".format(path, e.strerror))
+        raise LoadError()
+    except FormatError as e:
+        eprint.red("\nInvalid option: {0}".format(e))
+        raise LoadError()
+
+
+def read_matrix(path):
+    """Load a sweep matrix file, raising RuntimeError if unavailable or invalid."""
+    try:
+        with open(path) as f:
+            return load_matrix(f, path)
+    except IOError as e:
+        raise RuntimeError("Cannot open sweep matrix {0}: {1}".format(path, e.strerror))
+    except FormatError as e:
+        raise RuntimeError(str(e))
+
+
+def print_plan(plan):
+    """Print a compiled plan, one line per step."""
+    for stage, entry in plan.steps():
+        print("{:<9} {:<16} {:<16} {}".format(
+            stage, entry["step"], ",".join(entry.get("depends_on", [])) or "-",
+            entry.get("command", entry.get("template"))
+        ))
+        if "foreach" in entry:
+            print("{:<43} for each of {}{}".format(
+                "", entry["foreach"] if not isinstance(entry["foreach"], list) else " ".join(entry["foreach"]),
+                ", then: " + entry["gather"] if "gather" in entry else ""
+            ))
+
+
+def store_command(eprint, store, arguments):
+    """Run `store ls` or `store gc`. Returns exit code."""
+    if store is None:
+        eprint.red("store requires an image store directory (--store or $SINGULARITY_PIPELINE_STORE)")
+        return 1
+    if arguments == ["ls"]:
+        entries = store.entries()
+        for entry in entries:
+            print("{key}  {size:>8}  {last_used}  {source}".format(
+                key=entry["key"],
+                size=format_memory(entry["size"]),
+                last_used=time.strftime("%Y-%m-%d %H:%M", time.localtime(entry["last_used"])),
+                source=entry.get("source")
+            ))
+        eprint.bold("{} images, {} total.".format(len(entries), format_memory(sum(e["size"] for e in entries))))
+        return 0
+    if arguments == ["gc"]:
+        removed = store.gc()
+        eprint.bold("Removed {} entries from image store.".format(len(removed)))
+        return 0
+    eprint.red("Unknown store command; expected `store ls` or `store gc`")
+    return 1
+
+
+def compare(eprint, files, threshold, min_seconds=1.0):
+    """Compare two step reports, flagging slowed-down steps.
+
+    Returns exit code: 1 if any step regressed, 0 otherwise."""
+    if len(files) != 2:
+        eprint.red("compare requires two report files: OLD NEW")
+        return 1
+    try:
+        old, new = load_report(files[0]), load_report(files[1])
+    except (IOError, ValueError) as e:
+        eprint.red("Cannot load report: {}".format(e))
+        return 1
+
+    regressions = 0
+    for stage, step, old_time, new_time, flagged in compare_reports(old, new, threshold / 100.0, min_seconds):
+        line = "{:<9} {:<24} {:>10.4g}s {:>10.4g}s".format(stage, step, old_time, new_time)
+        if flagged:
+            regressions += 1
+            eprint.red(line + "  SLOWER")
+        else:
+            eprint.normal(line)
+
+    if regressions:
+        eprint.yellow("\n{} step(s) slowed down by more than {}%.".format(regressions, threshold))
+        return 1
+    eprint.bold("\nNo step slowed down by more than {}%.".format(threshold))
+    return 0
+
+
+class VersionAction(argparse.Action):
+    """Like argparse's "version" action, but only probes Singularity when invoked."""
+
+    def __init__(self, option_strings, dest=argparse.SUPPRESS, default=argparse.SUPPRESS,
+                 help="show program's version number and exit"):
+        super(VersionAction, self).__init__(
+            option_strings=option_strings, dest=dest, default=default, nargs=0, help=help
+        )
+
+    def __call__(self, parser, namespace, values, option_string=None):
+        try:
+            singularity_version = check_singularity()
+        except ToolError:
+            singularity_version = "Unknown/unsupported"
+
+        formatter = parser._get_formatter()
+        formatter.add_text(template_version.format(
+            version=__version__,
+            singularity_version=singularity_version
+        ))
+        parser._print_message(formatter.format_help(), sys.stdout)
+        parser.exit()
 
 
 def parse_args(args):
@@ -61,25 +295,28 @@ def parse_args(args):
         description="Pipeline, a wrapper around Singularity to build, run and test scientific pipelines."
     )
 
-    try:
-        singularity_version = check_singularity()
-    except ToolError:
-        singularity_version = "Unknown/unsupported"
-
-    parser.add_argument('-v', '--version', action='version', version=template_version.format(
-        version=__version__,
-        singularity_version=singularity_version
-    ))
+    parser.add_argument('-v', '--version', action=VersionAction)
 
     parser.add_argument(
         "command",
         help="Command to execute",
-        choices=['build', 'run', 'test', 'check', 'template']
+        choices=['build', 'run', 'test', 'build-and-test', 'sweep', 'serve', 'check', 'plan', 'compare', 'store',
+                 'template']
+    )
+    parser.add_argument(
+        "arguments",
+        nargs="*",
+        help="For compare, the old and new report files; for store, `ls` or `gc`"
     )
     parser.add_argument(
         "-p", "--pipeline",
-        default="pipeline.yaml",
-        help="Pipeline description file (default: '%(default)s')"
+        action="append",
+        help="Pipeline description file or glob; repeat to work on several pipelines (default: 'pipeline.yaml')"
+    )
+    parser.add_argument(
+        "--workspace",
+        metavar="FILE",
+        help="YAML file listing pipeline descriptions to work on together (default: none)"
     )
     parser.add_argument(
         "-i", "--image",
@@ -100,13 +337,181 @@ def parse_args(args):
         action="store_true",
         help="For testing, skip the run phase, only validating existing output (default: no)"
     )
+    parser.add_argument(
+        "--update-checksums",
+        action="store_true",
+        help="For testing, regenerate test checksums from current outputs instead of verifying them (default: no)"
+    )
     parser.add_argument(
         "--dry-run",
         action="store_true",
         help="Output the intended command sequence without executing it (default: no)"
     )
+    parser.add_argument(
+        "-j", "--jobs",
+        type=int,
+        default=1,
+        help="Maximum number of independent steps to run concurrently, 0 for no limit (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--store",
+        default=os.environ.get("SINGULARITY_PIPELINE_STORE"),
+        help="Shared image store directory deduplicating builds (default: $SINGULARITY_PIPELINE_STORE, if set)"
+    )
+    parser.add_argument(
+        "--store-max-size",
+        help="Evict least recently used store images above this total size, e.g. 200G"
+    )
+    parser.add_argument(
+        "--scratch",
+        help="Node-local directory for binds with a `stage` setting (default: $TMPDIR)"
+    )
+    parser.add_argument(
+        "--executor",
+        choices=EXECUTORS,
+        help="How run steps are executed: serial, pool (concurrent local processes), "
+             "slurm or pbs (batch jobs) (default: serial, or pool if --jobs is not 1)"
+    )
+    parser.add_argument(
+        "--batch-options",
+        default="",
+        help="Extra options for the batch submission command (sbatch/qsub)"
+    )
+    parser.add_argument(
+        "--cpus",
+        type=int,
+        help="CPUs shared by concurrent steps (default: detected from affinity/cgroup limits)"
+    )
+    parser.add_argument(
+        "--memory",
+        help="Memory shared by concurrent steps, e.g. 64G (default: detected from cgroup limits/RAM)"
+    )
+    parser.add_argument(
+        "--check-mode",
+        choices=["mtime", "hash"],
+        default="mtime",
+        help="How run steps declaring outputs are checked for being up to date (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--rebuild-step",
+        action="append",
+        metavar="STEP",
+        help="Run this step (name or number) even if its outputs are up to date; may be repeated"
+    )
+    parser.add_argument(
+        "-m", "--matrix",
+        help="For sweep, CSV/TSV or YAML file of substitution values, one run per row; "
+             "for check, its columns count as defined substitutions"
+    )
+    parser.add_argument(
+        "--json",
+        action="store_true",
+        help="For plan, print the compiled plan as JSON (default: no)"
+    )
+    parser.add_argument(
+        "--workers",
+        type=int,
+        default=1,
+        help="For sweep, serve and workspaces, maximum number of rows/requests/pipelines to run concurrently "
+             "(default: %(default)s)"
+    )
+    parser.add_argument(
+        "--socket",
+        default="pipeline.sock",
+        help="For serve, Unix socket to accept JSON run requests on (default: '%(default)s')"
+    )
+    parser.add_argument(
+        "--queue-size",
+        type=int,
+        default=16,
+        help="For serve, maximum number of requests waiting for a worker (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="Write per-step timings, CPU time, peak memory and exit codes to FILE as JSON"
+    )
+    parser.add_argument(
+        "--threshold",
+        type=float,
+        default=20,
+        help="For compare, percentage slowdown flagged as a regression (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--min-seconds",
+        type=float,
+        default=1.0,
+        help="For compare, minimum slowdown in seconds flagged as a regression (default: %(default)s)"
+    )
+    parser.add_argument(
+        "-q", "--quiet",
+        action="store_true",
+        help="Print no messages; combine with --events for machine consumption (default: no)"
+    )
+    parser.add_argument(
+        "--events",
+        metavar="TARGET",
+        help="Write structured events as JSON Lines to TARGET: a file, `-` for stdout, "
+             "`fd:N` for an open file descriptor or `unix:PATH` for a Unix socket"
+    )
+    parser.add_argument(
+        "--log-dir",
+        help="Capture each step's output to a log file in this directory (default: steps write to the terminal)"
+    )
+    parser.add_argument(
+        "--compress-logs",
+        action="store_true",
+        help="Gzip step log files (default: no)"
+    )
+    parser.add_argument(
+        "--prefix-output",
+        action="store_true",
+        help="Capture step output and print it live, each line prefixed with its step (default: no)"
+    )
+    parser.add_argument(
+        "--tail-lines",
+        type=int,
+        default=20,
+        help="Last lines of captured output shown when a step fails (default: %(default)s)"
+    )
+    parser.add_argument(
+        "--sample-interval",
+        type=float,
+        metavar="SECONDS",
+        help="Sample CPU, memory and I/O of running steps at this interval, saving time series "
+             "to <image>.samples/ and printing a summary per stage (default: no sampling)"
+    )
+    parser.add_argument(
+        "--resume",
+        action="store_true",
+        help="Skip run steps completed by the previous run with identical commands and substitutions (default: no)"
+    )
+    parser.add_argument(
+        "--instance",
+        action="store_true",
+        help="Run all steps inside one persistent Singularity instance (default: no)"
+    )
 
-    return parser.parse_args(args)
+    parsed = parser.parse_args(args)
+    if parsed.instance and parsed.executor in ["slurm", "pbs"]:
+        parser.error("--instance cannot be combined with batch executors")
+    try:
+        parsed.pipelines = find_descriptions(
+            parsed.pipeline or ([] if parsed.workspace else ["pipeline.yaml"]), parsed.workspace
+        )
+    except (IOError, OSError) as e:
+        parser.error("Cannot open workspace file {}: {}".format(parsed.workspace, e.strerror))
+    except FormatError as e:
+        parser.error(str(e))
+    if len(parsed.pipelines) > 1 or parsed.workspace:
+        if parsed.command in ["sweep", "serve", "plan"]:
+            parser.error("{} works on a single pipeline description".format(parsed.command))
+        if parsed.image:
+            parser.error("--image cannot be combined with several pipeline descriptions")
+    if not parsed.pipelines:
+        parser.error("Workspace file {} lists no pipeline descriptions".format(parsed.workspace))
+    parsed.pipeline = parsed.pipelines[0]
+    return parsed
 
 
 if __name__ == "__main__":
@@ -0,0 +1,100 @@
+"""In-process checksum validation of test outputs."""
+
+import multiprocessing
+
+from .errors import FormatError
+from .fingerprint import file_digest
+from .util import map_concurrently
+
+HASH_CHUNK_SIZE = 8 * 1024 * 1024
+
+ALGORITHMS_BY_LENGTH = {
+    32: "md5",
+    40: "sha1",
+    64: "sha256",
+    128: "sha512"
+}
+
+
+def guess_algorithm(digest):
+    """Infer the hash algorithm from the length of a hex digest."""
+    algorithm = ALGORITHMS_BY_LENGTH.get(len(digest))
+    if not algorithm:
+        raise FormatError("Cannot infer hash algorithm of checksum '{}'".format(digest))
+    return algorithm
+
+
+def read_checksum_file(path):
+    """Read a coreutils-style checksum file (`<digest>  <path>` per line).
+
+    Returns a dict of path -> expected digest."""
+    entries = {}
+    with open(path) as f:
+        for number, line in enumerate(f):
+            line = line.rstrip("\n")
+            if not line.strip() or line.startswith("#"):
+                continue
+            parts = line.split(None, 1)
+            if len(parts) != 2:
+                raise FormatError("Malformed line {} in checksum file {}".format(number + 1, path))
+            digest, name = parts
+            entries[name.lstrip("*")] = digest.lower()
+    return entries
+
+
+def write_checksum_file(path, entries):
+    """Write a dict of path -> digest as a coreutils-style checksum file."""
+    with open(path, "w") as f:
+        for name in sorted(entries):
+            f.write("{}  {}\n".format(entries[name], name))
+
+
+def load_checksums(spec):
+    """Interpret a `test.checksums` description.
+
+    spec is either a mapping of path -> hex digest, or the name of a
+    coreutils-style checksum file (as written by md5sum/sha256sum).
+    Returns (dict of path -> digest, checksum file name or None)."""
+    if isinstance(spec, dict):
+        entries, checksum_file = dict((str(name), str(digest or "").lower()) for name, digest in spec.items()), None
+    else:
+        try:
+            entries, checksum_file = read_checksum_file(spec), spec
+        except IOError as e:
+            raise FormatError("Cannot read checksum file {}: {}".format(spec, e.strerror))
+
+    for digest in entries.values():
+        if digest:
+            guess_algorithm(digest)
+    return entries, checksum_file
+
+
+def compute_checksums(entries, workers=None):
+    """Hash every file in entries with the algorithm of its current digest (sha256 if unknown).
+
+    Files are hashed in parallel; hashlib releases the GIL on large chunks.
+    Returns a dict of path -> digest, or None for missing/unreadable files."""
+    if workers is None:
+        workers = multiprocessing.cpu_count()
+
+    def digest(name):
+        algorithm = guess_algorithm(entries[name]) if entries[name] else "sha256"
+        try:
+            return file_digest(name, algorithm, chunk_size=HASH_CHUNK_SIZE)
+        except IOError:
+            return None
+
+    names = sorted(entries)
+    return dict(zip(names, map_concurrently(digest, names, workers=workers)))
+
+
+def verify_checksums(entries, workers=None):
+    """Verify all files against expected digests.
+
+    Returns a list of (path, expected, actual) for every mismatch;
+    actual is None for missing files."""
+    actual = compute_checksums(entries, workers)
+    return [
+        (name, entries[name], actual[name])
+        for name in sorted(entries) if actual[name] != entries[name]
+    ]
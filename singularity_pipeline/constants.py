@@ -1,2 +1,9 @@
 SUPPORTED_VERSION = "2.4"
 FORMAT_VERSION = 1
+FINGERPRINT_SUFFIX = ".fingerprint"
+STEP_STATE_SUFFIX = ".steps.json"
+VERSION_CACHE_FILE = "singularity-version.json"
+JOURNAL_SUFFIX = ".journal"
+BATCH_DIR_SUFFIX = ".jobs"
+SAMPLES_DIR_SUFFIX = ".samples"
+DESCRIPTION_CACHE_DIR = "descriptions"
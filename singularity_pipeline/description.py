@@ -0,0 +1,297 @@
+"""Loading pipeline descriptions: fast YAML parsing, schema validation and a parse cache."""
+
+import hashlib
+import io
+import os
+import re
+import sys
+import tempfile
+import yaml
+
+try:
+    import cPickle as pickle  # Python 2
+except ImportError:
+    import pickle
+
+try:
+    from yaml import CSafeLoader as SafeLoader  # libyaml bindings, much faster
+except ImportError:
+    from yaml import SafeLoader
+
+from . import __version__
+from .constants import FORMAT_VERSION, DESCRIPTION_CACHE_DIR
+from .errors import FormatError
+from .fingerprint import data_digest
+from .resources import parse_memory, parse_duration
+from .staging import STAGE_MODES
+from .steps import string_types
+from .util import ensure_directory
+
+MAX_ERRORS = 20  # Problems listed before the rest are summarized
+
+STRING = {"type": "string"}
+SCALAR = {"type": "scalar"}
+DURATION = {"type": "duration"}
+STRINGS = {"type": "list", "items": STRING}
+
+STEP = {
+    "type": "any_of",
+    "message": "must be a command string or a step mapping",
+    "options": [
+        STRING,
+        {
+            "type": "mapping",
+            "required": ["command"],
+            "keys": {
+                "command": STRING,
+                "name": SCALAR,
+                "depends_on": {
+                    "type": "any_of",
+                    "message": "must be a step name or a list of step names",
+                    "options": [SCALAR, {"type": "list", "items": SCALAR}]
+                },
+                "inputs": STRINGS,
+                "outputs": STRINGS,
+                "cpus": {"type": "positive_int"},
+                "memory": {"type": "memory"},
+                "timeout": DURATION,
+                "foreach": {
+                    "type": "any_of",
+                    "message": "must be a glob or a list of paths",
+                    "options": [STRING, STRINGS]
+                },
+                "gather": STRING,
+                "batch": {"type": "positive_int"},
+                "workers": {"type": "positive_int"}
+            }
+        }
+    ]
+}
+STEPS = {"type": "list", "items": STEP}
+
+SCHEMA = {
+    "type": "mapping",
+    "required": ["name", "version", "build", "run", "test"],
+    "keys": {
+        "format_version": {
+            "type": "enum",
+            "values": [FORMAT_VERSION],
+            "message": "incompatible format version {value}; expected " + str(FORMAT_VERSION)
+        },
+        "name": SCALAR,
+        "version": SCALAR,
+        "substitutions": {"type": "mapping", "values": SCALAR},
+        "binds": {
+            "type": "list",
+            "items": {
+                "type": "any_of",
+                "message": "must be a 'source:destination' string or a bind mapping",
+                "options": [
+                    {"type": "pattern", "pattern": r"^[^:]+:[^:]+", "message": "must be 'source:destination'"},
+                    {
+                        "type": "mapping",
+                        "required": ["source"],
+                        "keys": {
+                            "source": STRING,
+                            "dest": STRING,
+                            "stage": {"type": "enum", "values": STAGE_MODES}
+                        }
+                    }
+                ]
+            }
+        },
+        "build": {
+            "type": "mapping",
+            "required": ["type"],
+            "keys": {
+                "type": {
+                    "type": "enum",
+                    "values": ["pull", "bootstrap", "build", "docker2singularity", "custom"]
+                },
+                "source": STRING,
+                "size": SCALAR,
+                "options": STRING,
+                "commands": STEPS,
+                "convert": {"type": "mapping", "keys": {"compression": STRING, "level": SCALAR, "smoke": STRING}},
+                "credentials": {"type": "mapping", "values": SCALAR},
+                "timeout": DURATION
+            }
+        },
+        "run": {
+            "type": "mapping",
+            "required": ["commands"],
+            "keys": {"commands": STEPS, "timeout": DURATION}
+        },
+        "test": {
+            "type": "mapping",
+            "keys": {
+                "test_files": STRINGS,
+                "prepare_commands": STEPS,
+                "validate_commands": STEPS,
+                "checksums": {
+                    "type": "any_of",
+                    "message": "must be a checksum file name or a mapping of paths to digests",
+                    "options": [STRING, {"type": "mapping", "values": SCALAR}]
+                },
+                "timeout": DURATION
+            }
+        }
+    }
+}
+
+KINDS = {
+    "mapping": dict,
+    "list": list,
+    "string": string_types,
+    "pattern": string_types,
+    "scalar": (string_types, int, float)
+}
+
+
+def validate(description, schema=SCHEMA):
+    """Check a parsed description against the schema in one pass.
+
+    Returns a list of (path, message) problems, where path is a tuple of
+    mapping keys and list indices; empty if the description is valid."""
+    errors = []
+    check(description, schema, (), errors)
+    return errors
+
+
+def check(value, schema, path, errors):
+    """Check one value against a schema node, appending problems to errors."""
+    kind = schema["type"]
+    if kind == "any_of":
+        for option in schema["options"]:
+            if isinstance(value, KINDS.get(option["type"], object)):
+                check(value, option, path, errors)
+                return
+        errors.append((path, schema["message"]))
+    elif kind in KINDS and not isinstance(value, KINDS[kind]):
+        errors.append((path, "must be a {}".format("string" if kind == "pattern" else kind)))
+    elif kind == "mapping":
+        for key in schema.get("required", []):
+            if not value.get(key):
+                errors.append((path + (key,), "is required"))
+        for key, item in value.items():
+            if item is None:
+                continue  # Optional keys may be left empty
+            node = schema.get("keys", {}).get(key, schema.get("values"))
+            if node is not None:
+                check(item, node, path + (key,), errors)
+    elif kind == "list":
+        for index, item in enumerate(value):
+            check(item, schema["items"], path + (index,), errors)
+    elif kind == "pattern":
+        if not re.match(schema["pattern"], value):
+            errors.append((path, schema["message"]))
+    elif kind == "enum":
+        if value not in schema["values"]:
+            errors.append((path, schema.get("message", "must be one of {values}").format(
+                value=value, values=", ".join(str(option) for option in schema["values"])
+            )))
+    elif kind == "positive_int":
+        if not isinstance(value, int) or isinstance(value, bool) or value < 1:
+            errors.append((path, "must be a positive integer"))
+    elif kind in ["duration", "memory"]:
+        try:
+            parse_duration(value) if kind == "duration" else parse_memory(value)
+        except FormatError as e:
+            errors.append((path, str(e)))
+
+
+def format_path(path):
+    """Render a problem path, e.g. `run.commands[3].cpus`."""
+    text = ""
+    for part in path:
+        text += "[{}]".format(part) if isinstance(part, int) else (".{}" if text else "{}").format(part)
+    return text or "description"
+
+
+def locate(node, path):
+    """Return the (line, column) of the deepest node of path in a YAML node tree, 1-based."""
+    for part in path:
+        child = None
+        if isinstance(node, yaml.MappingNode):
+            child = next((value for key, value in node.value if key.value == str(part)), None)
+        elif isinstance(node, yaml.SequenceNode) and isinstance(part, int) and part < len(node.value):
+            child = node.value[part]
+        if child is None:
+            break
+        node = child
+    return node.start_mark.line + 1, node.start_mark.column + 1
+
+
+def format_errors(errors, text=None):
+    """Describe problems, one per line, with YAML locations if the text is given.
+
+    The text is only composed into nodes here, so valid descriptions are parsed once."""
+    root = yaml.compose(text, Loader=SafeLoader) if text is not None else None
+    lines = []
+    for path, message in errors[:MAX_ERRORS]:
+        if root is not None:
+            lines.append("line {}, column {} ({}): {}".format(*(locate(root, path) + (format_path(path), message))))
+        else:
+            lines.append("{}: {}".format(format_path(path), message))
+    if len(errors) > MAX_ERRORS:
+        lines.append("... and {} more problems".format(len(errors) - MAX_ERRORS))
+    return "\n  ".join(lines)
+
+
+def load_description(source, cache_dir=None):
+    """Parse and validate a description from a YAML string or file.
+
+    Descriptions read from files are cached in cache_dir (pickled, keyed by
+    the file's content hash and mtime), so loading an unchanged file again
+    skips parsing and validation. Raises yaml.YAMLError or FormatError."""
+    path = getattr(source, "name", None)
+    text = source.read() if hasattr(source, "read") else source
+
+    cache_file = None
+    if cache_dir and isinstance(path, string_types) and os.path.isfile(path):
+        cache_file = cache_filename(cache_dir, path, text)
+        try:
+            with open(cache_file, "rb") as f:
+                return pickle.load(f)
+        except (IOError, OSError, EOFError, ValueError, pickle.UnpicklingError):
+            pass  # Not cached, or unreadable: parse
+
+    stream = io.BytesIO(text) if isinstance(text, bytes) else io.StringIO(text)
+    stream.name = path if isinstance(path, string_types) else "<string>"  # Shown in parse errors
+    description = yaml.load(stream, Loader=SafeLoader)
+    errors = validate(description) if isinstance(description, dict) else [((), "must be a mapping")]
+    if errors:
+        raise FormatError(format_errors(errors, text))
+
+    if cache_file:
+        write_cache(cache_file, description)
+    return description
+
+
+def cache_filename(cache_dir, path, text):
+    """Cache file for a description file: <path digest>-<content, mtime and version digest>.pickle."""
+    content = text if isinstance(text, bytes) else text.encode("utf-8")
+    key = data_digest([
+        hashlib.sha256(content).hexdigest(), os.path.getmtime(path),
+        __version__, sys.version_info[:2], SafeLoader.__name__
+    ])
+    return os.path.join(cache_dir, DESCRIPTION_CACHE_DIR, "{}-{}.pickle".format(
+        data_digest(os.path.abspath(path))[:16], key[:32]
+    ))
+
+
+def write_cache(cache_file, description):
+    """Atomically store a parsed description, replacing older entries for the same file. Best-effort."""
+    directory = os.path.dirname(cache_file)
+    prefix = os.path.basename(cache_file).split("-")[0] + "-"
+    try:
+        ensure_directory(directory)
+        handle, temporary = tempfile.mkstemp(dir=directory, suffix=".tmp")
+        with os.fdopen(handle, "wb") as f:
+            pickle.dump(description, f, pickle.HIGHEST_PROTOCOL)
+        os.rename(temporary, cache_file)
+        for name in os.listdir(directory):
+            if name.startswith(prefix) and name != os.path.basename(cache_file):
+                os.remove(os.path.join(directory, name))
+    except (IOError, OSError):
+        pass  # Caching is best-effort
@@ -1,66 +1,226 @@
 from __future__ import print_function
 
+import json
+import os
+import socket
 import sys
+import threading
+import time
 import colorama
 
+STYLES = {
+    "normal": "",
+    "bold": colorama.Style.BRIGHT,
+    "red": colorama.Fore.RED + colorama.Style.BRIGHT,
+    "yellow": colorama.Fore.YELLOW + colorama.Style.BRIGHT,
+    "debug": colorama.Fore.CYAN + colorama.Style.BRIGHT,
+    "dim": colorama.Style.DIM
+}
+
 
 class EPrint():
-    def __init__(self, print_func=None, debug=False):
-        if not print_func:
-            print_func = self.__eprint
-        self.print_func = print_func
-        self.debug = debug
+    """Dispatches human-readable messages and structured events to sinks.
 
-    def __eprint(self, *args, **kwargs):
-        """Default print function: print to sys.stderr.
+    By default a single ConsoleSink prints colored messages to sys.stderr.
+    In quiet mode there is no console sink, and messages are dropped before
+    any formatting if no other sink takes them."""
 
-        Follows same format as print()."""
-        print(*args, file=sys.stderr, **kwargs)
+    def __init__(self, print_func=None, debug=False, sinks=None, quiet=False, context=None):
+        """Initialize an EPrint.
+
+        print_func - print()-like function used by the console sink (default: print to sys.stderr)
+        debug      - show debug messages
+        sinks      - additional sinks, e.g. JsonLinesSink
+        quiet      - no console output
+        context    - fields added to every event, e.g. the description it concerns"""
+        self.show_debug = debug
+        self.context = context or {}
+        self.sinks = list(sinks or [])
+        if not quiet:
+            self.sinks.insert(0, ConsoleSink(print_func))
+
+    def __message(self, style, args, kwargs):
+        """Pass a message to all sinks."""
+        for sink in self.sinks:
+            sink.message(style, args, kwargs)
 
     def normal(self, *args, **kwargs):
         """Print text normally.
 
         Follows same format as print()."""
-        self.print_func(*args, **kwargs)
+        self.__message("normal", args, kwargs)
 
     def bold(self, *args, **kwargs):
         """Print text as bold.
 
         Follows same format as print()."""
-        args = list(args)
-        if len(args):
-            args[0] = colorama.Style.BRIGHT + args[0]
-            args[-1] = args[-1] + colorama.Style.RESET_ALL
-        self.print_func(*args, **kwargs)
+        self.__message("bold", args, kwargs)
 
     def red(self, *args, **kwargs):
         """Print text as bold red.
 
         Follows same format as print()."""
-        args = list(args)
-        if len(args):
-            args[0] = colorama.Fore.RED + colorama.Style.BRIGHT + args[0]
-            args[-1] = args[-1] + colorama.Style.RESET_ALL
-        self.print_func(*args, **kwargs)
+        self.__message("red", args, kwargs)
 
     def yellow(self, *args, **kwargs):
         """Print text as bold yellow.
 
         Follows same format as print()."""
-        args = list(args)
-        if len(args):
-            args[0] = colorama.Fore.YELLOW + colorama.Style.BRIGHT + args[0]
-            args[-1] = args[-1] + colorama.Style.RESET_ALL
-        self.print_func(*args, **kwargs)
+        self.__message("yellow", args, kwargs)
 
     def debug(self, *args, **kwargs):
         """Print text as bold cyan if debug flag is set,
         does nothing otherwise.
 
         Follows same format as print()."""
-        if self.debug:
-            args = list(args)
-            if len(args):
-                args[0] = colorama.Fore.CYAN + colorama.Style.BRIGHT + args[0]
-                args[-1] = args[-1] + colorama.Style.RESET_ALL
+        if self.show_debug:
+            self.__message("debug", args, kwargs)
+
+    def prefixed(self, prefix, text):
+        """Print a line of step output, prefixed with a dim step label."""
+        for sink in self.sinks:
+            sink.output(prefix, text)
+
+    def event(self, name, **fields):
+        """Emit a structured event, e.g. `step.finished`, stamped with the current time."""
+        if not self.sinks:
+            return
+        fields["time"] = time.time()
+        for key, value in self.context.items():
+            fields.setdefault(key, value)
+        for sink in self.sinks:
+            sink.event(name, fields)
+
+    def close(self):
+        """Flush and close all sinks."""
+        for sink in self.sinks:
+            sink.close()
+
+
+class Sink():
+    """Base sink, ignoring everything; subclasses override what they handle."""
+
+    def message(self, style, args, kwargs):
+        """Handle a human-readable message; style is a key of STYLES."""
+
+    def output(self, prefix, text):
+        """Handle a line of captured step output."""
+
+    def event(self, name, fields):
+        """Handle a structured event."""
+
+    def close(self):
+        """Flush pending output."""
+
+
+class ConsoleSink(Sink):
+    """Colored messages and step output for humans."""
+
+    def __init__(self, print_func=None):
+        """Initialize a console sink printing with print_func (default: to sys.stderr)."""
+        if not print_func:
+            print_func = self.__eprint
+        self.print_func = print_func
+        self.lock = threading.Lock()  # Keeps lines from concurrent steps whole
+
+    def __eprint(self, *args, **kwargs):
+        """Default print function: print to sys.stderr.
+
+        Follows same format as print()."""
+        print(*args, file=sys.stderr, **kwargs)
+
+    def message(self, style, args, kwargs):
+        """Print a message in its style."""
+        args = list(args)
+        if len(args) and STYLES[style]:
+            args[0] = STYLES[style] + args[0]
+            args[-1] = args[-1] + colorama.Style.RESET_ALL
+        with self.lock:
             self.print_func(*args, **kwargs)
+
+    def output(self, prefix, text):
+        """Print a line of step output after its dim prefix."""
+        with self.lock:
+            self.print_func(STYLES["dim"] + prefix + colorama.Style.RESET_ALL + " " + text)
+
+
+class JsonLinesSink(Sink):
+    """Events, messages and step output as JSON Lines on a binary stream.
+
+    Writes go through the stream's buffer; a background thread flushes it
+    every flush_interval seconds while there are unflushed events, and the
+    stream is flushed when closed."""
+
+    def __init__(self, stream, flush_interval=1.0, messages=True):
+        """Initialize a JSON Lines sink.
+
+        stream         - binary file-like object
+        flush_interval - maximum seconds an event stays buffered
+        messages       - also emit human-readable messages and step output"""
+        self.stream = stream
+        self.flush_interval = flush_interval
+        self.messages = messages
+        self.dirty = False  # Events written since the last flush
+        self.lock = threading.Lock()
+        self.closed = threading.Event()
+        self.flusher = threading.Thread(target=self.flush_periodically)
+        self.flusher.daemon = True
+        self.flusher.start()
+
+    def message(self, style, args, kwargs):
+        """Emit a message as a `message` event."""
+        if self.messages:
+            self.event("message", {"style": style, "text": " ".join(str(arg) for arg in args).strip("\n"),
+                                   "time": time.time()})
+
+    def output(self, prefix, text):
+        """Emit a line of step output as an `output` event."""
+        if self.messages:
+            self.event("output", {"prefix": prefix, "text": text, "time": time.time()})
+
+    def event(self, name, fields):
+        """Write one event line."""
+        line = json.dumps(dict(fields, event=name), sort_keys=True) + "\n"
+        with self.lock:
+            try:
+                self.stream.write(line.encode("utf-8"))
+                self.dirty = True
+            except (IOError, OSError, ValueError):
+                pass  # Consumer went away; events are best-effort
+
+    def flush_periodically(self):
+        """Flush buffered events every flush_interval seconds until closed."""
+        while not self.closed.wait(self.flush_interval):
+            with self.lock:
+                if not self.dirty:
+                    continue
+                try:
+                    self.stream.flush()
+                except (IOError, OSError, ValueError):
+                    pass
+                self.dirty = False
+
+    def close(self):
+        """Stop flushing, then flush and close the stream."""
+        self.closed.set()
+        with self.lock:
+            try:
+                self.stream.close()
+            except (IOError, OSError):
+                pass
+
+
+def open_event_stream(spec):
+    """Open a binary stream for events from a specification.
+
+    `fd:N` - an inherited file descriptor, `unix:PATH` - a Unix stream socket,
+    `-` - standard output, anything else - a file appended to."""
+    if spec == "-":
+        return os.fdopen(os.dup(sys.stdout.fileno()), "wb", 65536)
+    if spec.startswith("fd:"):
+        return os.fdopen(int(spec[len("fd:"):]), "wb", 65536)
+    if spec.startswith("unix:"):
+        connection = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        connection.connect(spec[len("unix:"):])
+        return connection.makefile("wb", 65536)
+    return open(spec, "ab", 65536)
@@ -0,0 +1,31 @@
+"""Exception classes shared across the package."""
+
+
+class LoadError(RuntimeError):
+    """Exception class for failed file load or parse."""
+
+    pass
+
+
+class FormatError(ValueError):
+    """Exception class for non-conforming file format."""
+
+    def __init__(self, error):
+        """Store specific error description."""
+        self.error = error
+
+    def __str__(self):
+        """Print out specific error description as string representation."""
+        return self.error
+
+
+class ToolError(RuntimeError):
+    """Exception class for unexpected response from external tools."""
+
+    def __init__(self, error):
+        """Store specific error description."""
+        self.error = error
+
+    def __str__(self):
+        """Print out specific error description as string representation."""
+        return self.error
@@ -0,0 +1,299 @@
+"""Executor backends deciding where and how many steps run at once."""
+
+import copy
+import os
+import re
+import signal
+import subprocess
+import threading
+import time
+
+from .report import run_command, TIMEOUT_EXIT_CODE
+from .steps import run_steps
+from .util import ensure_directory
+
+EXECUTORS = ["serial", "pool", "slurm", "pbs"]
+CANCELLED_EXIT_CODE = -signal.SIGTERM  # Exit code reported for batch jobs cancelled via the cancel event
+
+
+class Executor():
+    """Base executor: runs steps locally, one at a time."""
+
+    local = True
+
+    def __init__(self, jobs=1, budget=None, registry=None, cancel_event=None):
+        """Initialize an executor.
+
+        jobs         - maximum number of concurrent steps (0 for no limit)
+        budget       - Budget shared by concurrent steps, if any
+        registry     - ProcessRegistry tracking running local processes, if any
+        cancel_event - threading.Event asking running steps to stop, if any"""
+        self.jobs = jobs
+        self.budget = budget
+        self.registry = registry
+        self.cancel_event = cancel_event
+
+    def __str__(self):
+        """Human-readable executor description."""
+        return "serial local execution"
+
+    def assign(self, step):
+        """Return (cpus, memory in bytes) to give a step, clamped to the budget if any."""
+        if self.budget:
+            return self.budget.assign(step)
+        return step.cpus, step.memory
+
+    def schedule(self, steps, launch):
+        """Run steps via launch(step) -> exit code, respecting dependencies.
+
+        Returns (exit code, failed Step), or (0, None)."""
+        return run_steps(steps, launch, jobs=self.jobs, budget=self.budget)
+
+    def clone(self, registry=None, cancel_event=None):
+        """Return a copy with its own process registry and cancel event, to run next to this one."""
+        clone = copy.copy(self)
+        clone.registry = registry
+        clone.cancel_event = cancel_event
+        return clone
+
+    def execute(self, step, command, resources, output=None, timeout=None, sampler=None, variant=None):
+        """Execute one formatted command; returns (exit code, measurements).
+
+        resources - (cpus, memory in bytes) assigned to the step.
+        output    - StepOutput capturing the command's output, or None to inherit the terminal.
+        timeout   - seconds after which the command is terminated, or None.
+        sampler   - Sampler following the command's resource usage, or None.
+        variant   - distinguishes concurrent executions of the same step, e.g. sweep rows."""
+        return run_command(command, self.registry, output, timeout, sampler)
+
+
+class SerialExecutor(Executor):
+    """Today's behavior: steps run one after another on the local host."""
+
+    def __init__(self, budget=None, registry=None):
+        """Initialize a serial executor."""
+        Executor.__init__(self, jobs=1, budget=budget, registry=registry)
+
+
+class PoolExecutor(Executor):
+    """Independent steps run as concurrent local processes."""
+
+    def __str__(self):
+        """Human-readable executor description."""
+        limit = "up to {} steps".format(self.jobs) if self.jobs else "independent steps"
+        return "{} concurrently within {}".format(limit, self.budget)
+
+
+class BatchExecutor(Executor):
+    """Steps are submitted as batch jobs (SLURM or PBS) as soon as their dependencies finish.
+
+    Each step gets a job script in `workdir` that writes its exit code to a
+    marker file on completion; the executor polls for markers, so it works
+    with any submission command printing a job id (e.g. a fake `sbatch`).
+    It also asks the scheduler for the job's state, so a job killed before
+    writing its marker (out of memory, walltime, node failure, cancelled by
+    an administrator) fails the step instead of being waited for forever.
+    Submitted jobs are cancelled (scancel/qdel) when the cancel event is set
+    or scheduling is interrupted, e.g. by Ctrl-C."""
+
+    local = False
+
+    SCHEDULERS = {
+        "slurm": {
+            "submit": "sbatch",
+            "cancel": "scancel",
+            "directives": [
+                "#SBATCH --job-name={name}",
+                "#SBATCH --output={log}",
+                "#SBATCH --cpus-per-task={cpus}",
+            ],
+            "memory": "#SBATCH --mem={memory}M",
+            "status": "squeue -h -j {job} -o %T",
+            "state": r"^\s*([A-Z_]+)",
+            "finished": ["BOOT_FAIL", "CANCELLED", "COMPLETED", "DEADLINE", "FAILED", "NODE_FAIL", "OUT_OF_MEMORY",
+                         "PREEMPTED", "TIMEOUT"]
+        },
+        "pbs": {
+            "submit": "qsub",
+            "cancel": "qdel",
+            "directives": [
+                "#PBS -N {name}",
+                "#PBS -j oe",
+                "#PBS -o {log}",
+                "#PBS -l nodes=1:ppn={cpus}",
+            ],
+            "memory": "#PBS -l mem={memory}mb",
+            "status": "qstat -f {job}",
+            "state": r"job_state\s*=\s*(\w+)",
+            "finished": ["C", "F"]
+        }
+    }
+
+    LOST_CHECKS = 2  # Polls a job must be finished without a marker before it is considered lost
+
+    def __init__(self, scheduler, workdir, options="", poll_interval=5, cancel_event=None):
+        """Initialize a batch executor.
+
+        scheduler     - "slurm" or "pbs"
+        workdir       - directory for job scripts, logs and completion markers
+        options       - extra options passed to the submission command
+        poll_interval - seconds between checks for completion markers
+        cancel_event  - threading.Event on which submitted jobs are cancelled, if any"""
+        Executor.__init__(self, jobs=0, cancel_event=cancel_event)
+        self.scheduler = scheduler
+        self.config = self.SCHEDULERS[scheduler]
+        self.workdir = workdir
+        self.options = options
+        self.poll_interval = poll_interval
+        self.outstanding = set()  # Ids of submitted jobs not known to be finished
+        self.lock = threading.Lock()
+
+    def __str__(self):
+        """Human-readable executor description."""
+        return "{} batch jobs ({})".format(self.scheduler.upper(), self.workdir)
+
+    def clone(self, registry=None, cancel_event=None):
+        """Return a copy with its own cancel event and outstanding jobs."""
+        clone = Executor.clone(self, registry, cancel_event)
+        clone.outstanding = set()
+        clone.lock = threading.Lock()
+        return clone
+
+    def schedule(self, steps, launch):
+        """Run steps as batch jobs; if scheduling is interrupted, cancel all outstanding jobs."""
+        try:
+            return Executor.schedule(self, steps, launch)
+        except BaseException:
+            self.cancel_jobs()
+            raise
+
+    def cancel_jobs(self):
+        """Cancel all submitted jobs that have not finished yet."""
+        with self.lock:
+            jobs = sorted(self.outstanding)
+            self.outstanding.clear()
+        if jobs:
+            subprocess.call("{} {}".format(self.config["cancel"], " ".join(jobs)), shell=True)
+
+    def cancel_job(self, job_id):
+        """Cancel one submitted job, unless it was already cancelled."""
+        with self.lock:
+            if job_id not in self.outstanding:
+                return
+            self.outstanding.discard(job_id)
+        subprocess.call("{} {}".format(self.config["cancel"], job_id), shell=True)
+
+    def execute(self, step, command, resources, output=None, timeout=None, sampler=None, variant=None):
+        """Submit the step as a batch job and wait for its completion marker.
+
+        Job files are named after the step and variant. The job log is passed
+        to output once the job has finished. The job script touches a start
+        marker, so the timeout counts from when the job starts running, not
+        while it is queued (measured as `queue_time`). On timeout or when the
+        cancel event is set, the job is cancelled.
+        A job that finished without writing its marker fails with exit code 1
+        and a `lost` measurement. Remote jobs are not sampled."""
+        cpus, memory = resources
+        ensure_directory(self.workdir)
+
+        name = step.key + ("-" + variant if variant else "")
+        base = os.path.join(os.path.abspath(self.workdir), "step-" + re.sub("[^A-Za-z0-9_.-]", "_", name))
+        marker = base + ".exit"
+        start_marker = base + ".started"
+        for path in [marker, start_marker]:
+            if os.path.exists(path):
+                os.remove(path)
+
+        directives = [line.format(name=name, log=base + ".log", cpus=cpus) for line in self.config["directives"]]
+        if memory:
+            directives.append(self.config["memory"].format(memory=max(1, memory // (1024 * 1024))))
+        with open(base + ".sh", "w") as f:
+            f.write("\n".join(["#!/bin/sh"] + directives + [
+                ": > {}".format(quote(start_marker)),
+                "cd {}".format(quote(os.getcwd())),
+                "( {} )".format(command),
+                "echo $? > {0}.tmp && mv {0}.tmp {0}".format(quote(marker)),
+                ""
+            ]))
+
+        started = time.time()
+        submit = "{} {} {}".format(self.config["submit"], self.options, quote(base + ".sh"))
+        try:
+            submitted = subprocess.check_output(submit, shell=True).decode("utf-8")
+        except subprocess.CalledProcessError as e:
+            return e.returncode, {"started": started, "wall_time": 0}
+        job_id = (re.findall(r"\d[\w.\[\]-]*", submitted) or [submitted.strip()])[-1]
+        with self.lock:
+            self.outstanding.add(job_id)
+
+        measurements = {"started": started, "job_id": job_id}
+        finished_polls = 0
+        state = None
+        running_since = None
+        try:
+            while not os.path.exists(marker):
+                if self.cancel_event is not None and self.cancel_event.is_set():
+                    self.cancel_job(job_id)
+                    measurements.update(wall_time=round(time.time() - started, 4), cancelled=True)
+                    return CANCELLED_EXIT_CODE, measurements
+                if running_since is None and os.path.exists(start_marker):
+                    running_since = time.time()
+                    measurements["queue_time"] = round(running_since - started, 4)
+                if timeout is not None and running_since is not None and time.time() - running_since > timeout:
+                    self.cancel_job(job_id)
+                    measurements.update(wall_time=round(time.time() - started, 4), timed_out=True)
+                    return TIMEOUT_EXIT_CODE, measurements
+                state = self.job_state(job_id)
+                if state is not None and (not state or state in self.config["finished"]):
+                    finished_polls += 1  # Gives the marker time to appear on shared filesystems
+                    if finished_polls >= self.LOST_CHECKS and not os.path.exists(marker):
+                        break
+                else:
+                    finished_polls = 0
+                time.sleep(self.poll_interval)
+        except BaseException:
+            self.cancel_job(job_id)
+            raise
+        with self.lock:
+            self.outstanding.discard(job_id)
+
+        if os.path.exists(marker):
+            with open(marker) as f:
+                ret_code = int(f.read().strip() or 1)
+        else:
+            ret_code = 1
+            measurements.update(lost=True, job_state=state or "no longer queued")
+        if output is not None and os.path.exists(base + ".log"):
+            with open(base + ".log", "rb") as f:
+                output.feed(f)
+        measurements["wall_time"] = round(time.time() - started, 4)
+        return ret_code, measurements
+
+    def job_state(self, job_id):
+        """Return the scheduler's state of a job, "" if it doesn't know the job,
+        or None if the scheduler can't be queried (e.g. no `squeue` on PATH)."""
+        process = subprocess.Popen(self.config["status"].format(job=job_id), shell=True,
+                                   stdout=subprocess.PIPE, stderr=subprocess.PIPE)
+        stdout, _ = process.communicate()
+        if process.returncode in [126, 127]:  # Status command not executable or not found
+            return None
+        match = re.search(self.config["state"], stdout.decode("utf-8", "replace"), re.MULTILINE)
+        return match.group(1) if match else ""
+
+
+def make_executor(name, jobs=1, budget=None, registry=None, workdir=None, options="", cancel_event=None):
+    """Create an executor by name (see EXECUTORS); name None picks serial or pool from jobs."""
+    if name is None:
+        name = "serial" if jobs == 1 else "pool"
+    if name == "serial":
+        return SerialExecutor(budget, registry)
+    if name == "pool":
+        return PoolExecutor(jobs, budget, registry)
+    if name in BatchExecutor.SCHEDULERS:
+        return BatchExecutor(name, workdir, options, cancel_event=cancel_event)
+    raise ValueError("Unknown executor '{}'".format(name))
+
+
+def quote(value):
+    """Quote a string for safe use in a POSIX shell."""
+    return "'" + value.replace("'", "'\"'\"'") + "'"
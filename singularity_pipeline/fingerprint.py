@@ -0,0 +1,21 @@
+"""Content hashing helpers used to detect changes in inputs."""
+
+import hashlib
+import json
+
+CHUNK_SIZE = 1024 * 1024
+
+
+def file_digest(path, algorithm="sha256", chunk_size=CHUNK_SIZE):
+    """Return the hex digest of a file's contents, read in chunks."""
+    digest = hashlib.new(algorithm)
+    with open(path, "rb") as f:
+        for chunk in iter(lambda: f.read(chunk_size), b""):
+            digest.update(chunk)
+    return digest.hexdigest()
+
+
+def data_digest(data, algorithm="sha256"):
+    """Return the hex digest of a JSON-serializable structure, independent of key order."""
+    serialized = json.dumps(data, sort_keys=True, default=str)
+    return hashlib.new(algorithm, serialized.encode("utf-8")).hexdigest()
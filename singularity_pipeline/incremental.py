@@ -0,0 +1,90 @@
+"""Make-style up-to-date checks for run steps declaring inputs and outputs."""
+
+import json
+import os
+import threading
+
+from .constants import FINGERPRINT_SUFFIX
+from .fingerprint import file_digest, data_digest
+
+CHECK_MODES = ["mtime", "hash"]
+
+
+class StepState():
+    """Persistent record of successfully completed steps.
+
+    Stored as JSON next to the image, keyed by step key. Each record holds
+    the digest of the formatted command and, in "hash" mode, the content
+    digests of the step's inputs, outputs and the image fingerprint."""
+
+    def __init__(self, path, mode="mtime"):
+        """Load existing state from path, if any."""
+        if mode not in CHECK_MODES:
+            raise ValueError("Unknown up-to-date check mode '{}'".format(mode))
+        self.path = path
+        self.mode = mode
+        self.lock = threading.Lock()
+        try:
+            with open(path) as f:
+                self.records = json.load(f)
+        except (IOError, ValueError):
+            self.records = {}
+
+    def is_up_to_date(self, key, command, inputs, outputs, image):
+        """Check whether a step's outputs are current.
+
+        True if all outputs exist, the command is unchanged since the last
+        successful run, and the outputs are newer than (mtime mode) or were
+        produced from identical (hash mode) inputs and image."""
+        if not outputs or not all(os.path.exists(path) for path in outputs):
+            return False
+        record = self.records.get(key)
+        if not record or record.get("command") != data_digest(command):
+            return False
+        if not all(os.path.exists(path) for path in inputs):
+            return False
+
+        if self.mode == "hash":
+            return (
+                record.get("inputs") == self.__digests(inputs) and
+                record.get("outputs") == self.__digests(outputs) and
+                record.get("image") == self.__image_digest(image)
+            )
+
+        newest_input = max([os.path.getmtime(path) for path in inputs + [image] if os.path.exists(path)] or [0])
+        oldest_output = min(os.path.getmtime(path) for path in outputs)
+        return oldest_output >= newest_input
+
+    def record(self, key, command, inputs, outputs, image):
+        """Record a successful step run and save the state file."""
+        record = {"command": data_digest(command)}
+        if self.mode == "hash":
+            record["inputs"] = self.__digests(inputs)
+            record["outputs"] = self.__digests(outputs)
+            record["image"] = self.__image_digest(image)
+        with self.lock:
+            self.records[key] = record
+            temp_path = self.path + ".tmp"
+            with open(temp_path, "w") as f:
+                json.dump(self.records, f, indent=1, sort_keys=True)
+            os.rename(temp_path, self.path)
+
+    def __digests(self, paths):
+        """Map each existing file to its content digest (directories by listing)."""
+        digests = {}
+        for path in paths:
+            if os.path.isfile(path):
+                digests[path] = file_digest(path)
+            elif os.path.isdir(path):
+                digests[path] = data_digest(sorted(os.listdir(path)))
+        return digests
+
+    def __image_digest(self, image):
+        """Identify the image by its build fingerprint if present, its size and mtime otherwise."""
+        try:
+            with open(image + FINGERPRINT_SUFFIX) as f:
+                return f.read().strip()
+        except IOError:
+            if os.path.exists(image):
+                return "{}:{}".format(os.path.getsize(image), os.path.getmtime(image))
+            return None
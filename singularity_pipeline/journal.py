@@ -0,0 +1,96 @@
+"""Append-only step journal enabling resumption of interrupted runs."""
+
+import fcntl
+import json
+import os
+import threading
+import time
+
+
+class Journal():
+    """Append-only JSON Lines record of step starts and finishes.
+
+    Use as a context manager. The journal file is exclusively locked while
+    open, so two runs can't interleave; the lock is released by the OS if the
+    process is killed. Steps that started but never finished, and a truncated
+    last line left by a killed process, are treated as not completed.
+
+    Every record is flushed to the OS, which keeps it if the process is killed.
+    Only successful finishes, the records resuming relies on, are also synced
+    to disk, so each step costs at most one fsync; a record lost in an OS
+    crash only makes a step run again."""
+
+    def __init__(self, path, resume=False):
+        """Prepare a journal at path; with resume, keep and load previous records."""
+        self.path = path
+        self.resume = resume
+        self.completed = {}
+        self.lock = threading.Lock()
+        self.file = None
+
+    def __enter__(self):
+        self.file = open(self.path, "a+")
+        try:
+            fcntl.flock(self.file.fileno(), fcntl.LOCK_EX | fcntl.LOCK_NB)
+        except (IOError, OSError):
+            self.file.close()
+            raise RuntimeError("Journal {} is locked by another running pipeline".format(self.path))
+
+        if self.resume:
+            self.file.seek(0)
+            line = "\n"
+            for line in self.file:
+                try:
+                    record = json.loads(line)
+                except ValueError:
+                    continue  # Partial line from an interrupted write
+                if record.get("event") == "finish" and record.get("exit_code") == 0:
+                    self.completed[record["step"]] = (record["command"], record["substitutions"])
+                elif record.get("event") == "start":
+                    self.completed.pop(record["step"], None)
+            if not line.endswith("\n"):
+                self.file.write("\n")  # Terminate a partial last line
+        else:
+            self.file.truncate(0)
+            os.fsync(self.file.fileno())  # Records of the previous run must not reappear after a crash
+        return self
+
+    def __exit__(self, *exc_info):
+        self.file.close()  # Also releases the lock
+        self.file = None
+
+    def is_completed(self, step, command_hash, substitutions_hash):
+        """Check whether a previous run completed this step with identical command and substitutions."""
+        return self.completed.get(step.key) == (command_hash, substitutions_hash)
+
+    def started(self, step, command_hash, substitutions_hash):
+        """Record the start of a step."""
+        self.__append(sync=False, record={
+            "event": "start",
+            "index": step.index,
+            "step": step.key,
+            "command": command_hash,
+            "substitutions": substitutions_hash,
+            "time": time.time()
+        })
+
+    def finished(self, step, command_hash, substitutions_hash, exit_code):
+        """Record the end of a step; successful ones are synced to disk."""
+        self.__append(sync=not exit_code, record={
+            "event": "finish",
+            "index": step.index,
+            "step": step.key,
+            "command": command_hash,
+            "substitutions": substitutions_hash,
+            "exit_code": exit_code,
+            "time": time.time()
+        })
+
+    def __append(self, record, sync):
+        """Append one record as a single line and flush it, to disk if sync."""
+        line = json.dumps(record, sort_keys=True) + "\n"
+        with self.lock:
+            self.file.write(line)
+            self.file.flush()
+            if sync:
+                os.fsync(self.file.fileno())
@@ -0,0 +1,86 @@
+"""Per-step capture of command output to log files, the console and a failure tail."""
+
+import collections
+import gzip
+import os
+import re
+
+from .util import ensure_directory
+
+MAX_LINE = 64 * 1024  # Longer lines are split, so a single line never buffers unbounded output
+
+
+class StepOutput():
+    """Destination for the output of one step, fed line by line while it runs.
+
+    Lines are appended to an optional (gzip-compressed) log file, passed to an
+    optional echo callable and kept in a ring buffer of the last `tail_lines`
+    lines, so memory use stays bounded whatever the step prints."""
+
+    def __init__(self, path=None, compress=False, tail_lines=20, echo=None):
+        """Initialize a step output.
+
+        path       - log file to write, or None
+        compress   - gzip the log file
+        tail_lines - number of last lines kept for failure messages
+        echo       - callable(text) receiving each decoded line, or None"""
+        self.path = path
+        self.echo = echo
+        self.tail_lines = collections.deque(maxlen=tail_lines)
+        self.partial = b""  # Start of a line split at MAX_LINE, not yet complete
+        self.file = None
+        if path:
+            ensure_directory(os.path.dirname(path))
+            self.file = gzip.open(path, "wb") if compress else open(path, "wb")
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def write(self, data):
+        """Consume one chunk of raw output, as read with readline(MAX_LINE)."""
+        if self.file:
+            self.file.write(data)
+        if not data.endswith(b"\n") and len(self.partial) < MAX_LINE:
+            self.partial += data
+            return
+        self.__line(self.partial + data)
+        self.partial = b""
+
+    def __line(self, data):
+        """Keep a complete line in the tail and echo it."""
+        text = data.decode("utf-8", "replace").rstrip("\r\n")
+        self.tail_lines.append(text)
+        if self.echo:
+            self.echo(text)
+
+    def feed(self, stream):
+        """Copy a binary stream to the output until EOF, one line at a time."""
+        for data in iter(lambda: stream.readline(MAX_LINE), b""):
+            self.write(data)
+
+    def tail(self):
+        """The last captured lines, oldest first."""
+        return list(self.tail_lines)
+
+    def close(self):
+        """Flush a trailing partial line and close the log file."""
+        if self.partial:
+            self.__line(self.partial)
+            self.partial = b""
+        if self.file:
+            self.file.close()
+            self.file = None
+
+
+def log_filename(log_dir, stage, step, variant=None, compress=False, extension=".log"):
+    """Path of the log file of a step, e.g. `logs/run-3.log.gz`.
+
+    variant - distinguishes concurrent runs of the same step, e.g. sweep rows."""
+    name = "{}-{}".format(stage, step.key)
+    if variant:
+        name += "-" + variant
+    name = re.sub("[^A-Za-z0-9_.-]", "_", name) + extension
+    return os.path.join(log_dir, name + (".gz" if compress else ""))
@@ -2,27 +2,115 @@
 # -*- coding: utf-8 -*-
 """Pipeline, a wrapper around Singularity to build, run and test scientific pipelines."""
 
+import contextlib
+import copy
+import errno
+import functools
+import itertools
+import json
 import os
 import string
 import subprocess
 import yaml
 import re
+import shutil
+import signal
+import tempfile
+import threading
+import time
 
 from .eprint import EPrint
-from .constants import SUPPORTED_VERSION, FORMAT_VERSION
+from .errors import LoadError, FormatError, ToolError
+from .steps import parse_steps, run_steps
+from .fingerprint import file_digest, data_digest
+from .incremental import StepState
+from .sweep import row_label
+from .util import map_concurrently, ensure_directory
+from .report import Report, ProcessRegistry, run_command, TIMEOUT_EXIT_CODE
+from .executors import make_executor, SerialExecutor
+from .logs import StepOutput, log_filename
+from .plan import Plan, template_fields, format_step, format_gather, expand_items
+from .description import load_description, validate, format_errors
+from .sampler import Sampler
+from .journal import Journal
+from .resources import Budget, format_memory, parse_duration
+from .staging import stage_in, stage_out
+from .store import ImageStore
+from .checksums import load_checksums, verify_checksums, compute_checksums, write_checksum_file
+from .constants import (SUPPORTED_VERSION, FINGERPRINT_SUFFIX, STEP_STATE_SUFFIX, JOURNAL_SUFFIX,
+                        BATCH_DIR_SUFFIX, SAMPLES_DIR_SUFFIX, VERSION_CACHE_FILE)
+
+
+CANCELLED = -signal.SIGTERM  # Exit code reported for steps skipped by cancel()
+_instance_numbers = itertools.count(1)  # Tells instances started by one process apart
+
+
+def entry_point(method):
+    """Decorate a pipeline action so that the outermost one clears a previous cancel().
+
+    Nested actions (test() calling run(), build_and_test() calling build())
+    keep the cancellation state of the action that started them."""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self.entry_lock:
+            if not self.entries:
+                self.cancel_event.clear()
+            self.entries += 1
+        try:
+            return method(self, *args, **kwargs)
+        finally:
+            with self.entry_lock:
+                self.entries -= 1
+    return wrapper
 
 
 class Pipeline():
     """Main Pipeline class."""
 
-    def __init__(self, source, imagefile=None, eprint_instance=None, dry_run=False):
+    def __init__(self, source, imagefile=None, eprint_instance=None, dry_run=False, jobs=1,
+                 check_mode="mtime", rebuild_steps=None, use_instance=False, report=False, resume=False,
+                 cpus=None, memory=None, executor=None, batch_options="", store=None, scratch=None,
+                 log_dir=None, compress_logs=False, tail_lines=20, prefix_output=False, sample_interval=None):
         """Initialize a pipeline instance.
 
-        Requires a YAML-formatted description (string or file handle)."""
+        Requires a YAML-formatted description (string or file handle).
+        jobs - maximum number of independent steps to run concurrently (0 for no limit).
+        check_mode - how run steps with outputs are checked for being up to date ("mtime" or "hash").
+        rebuild_steps - names or numbers of run steps to execute even if up to date.
+        use_instance - run/test inside one persistent Singularity instance.
+        report - collect per-step timings and resource usage in self.report.
+        resume - skip run steps completed by a previous run, according to the step journal.
+        cpus, memory - resource budget shared by concurrent steps (default: detected from host).
+        executor - run step executor: serial, pool, slurm or pbs (default: serial or pool, by jobs).
+        batch_options - extra options for the batch submission command.
+        store - ImageStore shared between pipelines to deduplicate builds.
+        scratch - node-local directory for staged binds (default: $TMPDIR).
+        log_dir - capture each step's output to a log file in this directory.
+        compress_logs - gzip step log files.
+        tail_lines - number of last output lines of a failed step shown in its failure message.
+        prefix_output - capture step output and print it live, each line prefixed with its step.
+        sample_interval - seconds between samples of the CPU, memory and I/O use of running
+                          local steps, saved in `<image>.samples/` (default: no sampling).
+
+        Without log_dir or prefix_output, steps write to the terminal directly."""
         if not eprint_instance:
             eprint_instance = EPrint()
         self.eprint = eprint_instance
         self.dry_run = dry_run
+        self.jobs = jobs
+        self.budget = Budget(cpus, memory)
+        self.check_mode = check_mode
+        self.rebuild_steps = [str(step) for step in (rebuild_steps or [])]
+        self.use_instance = use_instance
+        self.resume = resume
+        self.store = store
+        self.scratch = scratch or tempfile.gettempdir()
+        self.log_dir = log_dir
+        self.compress_logs = compress_logs
+        self.tail_lines = tail_lines
+        self.prefix_output = prefix_output
+        self.sample_interval = sample_interval
+        self.instance_name = None
 
         self.load_description(source)
 
@@ -33,19 +121,52 @@ class Pipeline():
                 "{}-{}.img".format(self.description.get("name"), self.description.get("version"))
             )
 
+        self.processes = ProcessRegistry()
+        self.cancel_event = threading.Event()
+        self.entry_lock = threading.Lock()
+        self.entries = 0  # Pipeline actions in progress, see entry_point()
+        self.executor = make_executor(
+            executor, jobs=jobs, budget=self.budget, registry=self.processes,
+            workdir=self.imagefile + BATCH_DIR_SUFFIX, options=batch_options, cancel_event=self.cancel_event
+        )
+        if self.use_instance and not self.executor.local:
+            raise ValueError("Persistent instances cannot be used with batch executors")
+
+        self.plan = self.compile_plan()
+
+        self.report = None
+        if report:
+            self.report = Report(
+                pipeline=self.description.get("name"),
+                version=self.description.get("version"),
+                image=self.imagefile
+            )
+
         self.eprint.normal("Target image file: {}\n".format(self.imagefile))
 
     def load_description(self, source):
-        """Load pipeline description from a file or a YAML string."""
+        """Load pipeline description from a file or a YAML string.
+
+        Descriptions read from files are cached after validation, see description.load_description."""
         self.eprint.bold("# Loading pipeline description...")
         try:
-            self.description = yaml.safe_load(source)
-            self.validate_description(self.description)
+            self.description = load_description(source, cache_directory())
+
+            self.binds = []
+            self.bind_stages = {}
+            for spec in self.description.get("binds") or []:
+                if isinstance(spec, dict):
+                    if spec.get("stage"):
+                        self.bind_stages[len(self.binds)] = spec.get("stage")
+                    self.binds.append((spec.get("source"), spec.get("dest", spec.get("source"))))
+                else:
+                    self.binds.append((spec.split(":")[0], spec.split(":")[1]))
+            self.bind_overrides = {}
 
-            bind_specs = self.description.get("binds", [])
-            self.binds = [
-                (spec.split(":")[0], spec.split(":")[1]) for spec in bind_specs
-            ]
+            self.stage_timeouts = {}
+            for stage in ["build", "run", "test"]:
+                if isinstance(self.description.get(stage), dict) and "timeout" in self.description.get(stage):
+                    self.stage_timeouts[stage] = parse_duration(self.description.get(stage).get("timeout"))
 
             self.eprint.normal("Pipeline '{name}' version {version} loaded.".format(
                 name=self.description.get("name"),
@@ -58,32 +179,94 @@ class Pipeline():
             self.eprint.red("\nPipeline description error: {0}".format(e))
             raise LoadError()
 
+    def compile_plan(self):
+        """Compile all stages into a Plan, validating every command template up front.
+
+        Raises LoadError on malformed commands or step definitions."""
+        try:
+            plan = Plan(self.substitution_dictionary())
+            build_calls, build_subs = self.__build_plan()
+            plan.add_stage("build", build_calls, build_subs)
+            test = self.description.get("test")
+            if test.get("prepare_commands") is not None:
+                plan.add_stage("prepare", test.get("prepare_commands"))
+            plan.add_stage("run", self.description.get("run").get("commands"))
+            if test.get("validate_commands") is not None:
+                plan.add_stage("validate", test.get("validate_commands"))
+            return plan
+        except (FormatError, NotImplementedError) as e:
+            self.eprint.red("\nPipeline description error: {0}".format(e))
+            raise LoadError()
+
     def validate_description(self, description):
-        """Validate dict-parsed pipeline description."""
-        format_version = description.get("format_version")
-        if not format_version:
-            format_version = 1  # Assuming format version 1 if not specified
-        
-        if format_version != FORMAT_VERSION:
-            raise FormatError("Incompatible format version {}; expected {}".format(format_version, FORMAT_VERSION))
-
-        for attribute in ["name", "version", "build", "run", "test"]:
-            if not description.get(attribute):
-                raise FormatError("Missing attribute '{}'".format(attribute))
+        """Validate dict-parsed pipeline description against the description schema."""
+        errors = validate(description)
+        if errors:
+            raise FormatError(format_errors(errors))
 
+    @entry_point
     def build(self, force=False):
-        """Build pipeline according to description."""
+        """Build pipeline according to description.
+
+        An existing image is reused only if its stored build fingerprint
+        matches the current description (see build_fingerprint())."""
         self.eprint.bold("# Building pipeline...\n")
+        self.__event("build.started", image=self.imagefile)
+
+        build_calls, build_subs = self.__build_plan()
+        fingerprint = self.build_fingerprint()
+        fingerprint_file = self.imagefile + FINGERPRINT_SUFFIX
 
         if not self.dry_run:
+            if os.path.islink(self.imagefile) and not os.path.exists(self.imagefile):
+                os.remove(self.imagefile)  # Dangling link to an evicted store entry
             if os.path.exists(self.imagefile):
                 if force:
                     self.eprint.normal("Deleting existing image file {}.".format(self.imagefile))
                     os.remove(self.imagefile)
-                else:
-                    self.eprint.yellow("Image file {} already exists! Skipping build.".format(self.imagefile))
+                elif read_fingerprint(fingerprint_file) == fingerprint:
+                    self.eprint.yellow("Image file {} is up to date! Skipping build.".format(self.imagefile))
+                    self.__event("build.skipped", image=self.imagefile, reason="up to date")
                     return
+                else:
+                    self.eprint.yellow("Image file {} is out of date with the build description; rebuilding.".format(
+                        self.imagefile
+                    ))
+                    os.remove(self.imagefile)
+            if os.path.exists(fingerprint_file):
+                os.remove(fingerprint_file)
+
+        if self.store and not self.dry_run:
+            source = self.description.get("build").get("source")
+            key = ImageStore.key(source, fingerprint)
+            with self.store.locked(key):
+                if self.store.has(key) and not force:
+                    self.store.fetch(key, self.imagefile)
+                    self.eprint.yellow("Image for {} found in store {}; linked to {}.".format(
+                        source, self.store.path, self.imagefile
+                    ))
+                    self.__event("build.skipped", image=self.imagefile, reason="store", key=key)
+                else:
+                    self.__build_image(build_calls, build_subs)
+                    self.store.add(
+                        key, self.imagefile, source=source, fingerprint=fingerprint,
+                        pipeline=self.description.get("name"), version=self.description.get("version")
+                    )
+            for removed in self.store.gc():
+                self.eprint.normal("Evicted {} from image store.".format(removed))
+        else:
+            self.__build_image(build_calls, build_subs)
+
+        if self.dry_run:
+            self.eprint.bold("# Dry-run of building image {} complete.\n".format(self.imagefile))
+        else:
+            with open(fingerprint_file, "w") as f:
+                f.write(fingerprint + "\n")
+            self.eprint.bold("# Successfully built image {}.\n".format(self.imagefile))
+            self.__event("build.finished", image=self.imagefile, fingerprint=fingerprint)
 
+    def __build_image(self, build_calls, build_subs):
+        """Run the build commands, passing registry credentials through the environment."""
         credentials = self.description.get("build").get("credentials")
         if credentials:
             if credentials.get("username"):
@@ -91,6 +274,100 @@ class Pipeline():
             if credentials.get("password"):
                 os.environ["SINGULARITY_DOCKER_PASSWORD"] = credentials.get("password")
 
+        ret_code, step = self.__run_batch(build_calls, build_subs, stage="build",
+                                          timeout=self.stage_timeouts.get("build"))
+        if ret_code:
+            raise RuntimeError(failure_message("Singularity build failed", step, ret_code))
+
+        if self.description.get("build").get("convert"):
+            self.__convert_image(self.description.get("build").get("convert"))
+
+    def __convert_image(self, convert):
+        """Convert the built image to a compressed read-only one, comparing size and exec latency.
+
+        Singularity 2.x produces squashfs (.simg), 3.x SIF (.sif). The result is
+        smoke-tested with `exec`; with `replace`, it becomes the pipeline image."""
+        self.eprint.bold("# Converting image...\n")
+        modern = singularity_major(check_singularity()) >= 3
+        target = self.imagefile + (".sif" if modern else ".simg")
+
+        options = ""
+        if convert.get("compression"):
+            if modern:
+                level = convert.get("level")
+                options = '--mksquashfs-args "-comp {}{}"'.format(
+                    convert.get("compression"), " -Xcompression-level {}".format(level) if level else ""
+                )
+            else:
+                self.eprint.yellow("Compression cannot be selected with Singularity 2.x; using default.")
+
+        smoke = "singularity exec {{image}} {}".format(convert.get("smoke", "true"))
+        if self.dry_run:
+            self.__run_batch(["singularity build {options} {target} {image}", smoke.replace("{image}", target)],
+                             {"options": options, "target": target}, stage="convert")
+            return
+
+        if os.path.exists(target):
+            os.remove(target)
+        ret_code, step = self.__run_batch(["singularity build {options} {target} {image}"],
+                                          {"options": options, "target": target}, stage="convert")
+        if ret_code:
+            raise RuntimeError(failure_message("Singularity image conversion failed", step, ret_code))
+
+        results = {}
+        for label, image in [("original", self.imagefile), ("converted", target)]:
+            ret_code, measurements = run_command(smoke.format(image=image), self.processes)
+            if ret_code:
+                raise RuntimeError("Smoke test of {} image {} failed (exit code {})".format(label, image, ret_code))
+            results[label] = {"size": os.path.getsize(image), "exec_latency": measurements["wall_time"]}
+
+        self.eprint.normal("Image size: {}B -> {}B; first exec latency: {:.2f}s -> {:.2f}s.\n".format(
+            format_memory(results["original"]["size"]), format_memory(results["converted"]["size"]),
+            results["original"]["exec_latency"], results["converted"]["exec_latency"]
+        ))
+        if self.report:
+            self.report.metadata["conversion"] = dict(results, target=target, compression=convert.get("compression"))
+
+        if convert.get("replace"):
+            os.rename(target, self.imagefile)
+            self.eprint.normal("Converted image replaces {}.".format(self.imagefile))
+
+    def build_fingerprint(self):
+        """Return a digest of everything that determines the built image.
+
+        Covers the build section (minus credentials and timeout), the resolved build
+        substitutions and, for build/docker2singularity types, the contents
+        of the local source file. Only substitutions used by the build commands
+        count, minus those depending on where the image is stored, so identical
+        builds match across pipelines."""
+        build = dict(self.description.get("build"))
+        build.pop("credentials", None)
+        build.pop("timeout", None)
+        build_calls, build_subs = self.__build_plan()
+
+        source_digest = None
+        if build.get("type") in ["build", "docker2singularity"]:
+            source = build.get("source")
+            if source and os.path.isfile(source):
+                source_digest = file_digest(source)
+
+        used = set()
+        for call in build_calls:
+            used |= template_fields(call)
+        subs = dict(
+            (name, value) for name, value in self.substitution_dictionary(**build_subs).items()
+            if name in used and name not in ["image", "binds", "exec", "run"]
+        )
+
+        return data_digest({
+            "build": build,
+            "commands": build_calls,
+            "substitutions": subs,
+            "source": source_digest
+        })
+
+    def __build_plan(self):
+        """Return (build commands, extra substitutions) for the described build type."""
         build_type = self.description.get("build").get("type")
 
         source = self.description.get("build").get("source")
@@ -117,129 +394,686 @@ class Pipeline():
         else:
             raise NotImplementedError("Build type {} not implemented.".format(build_type))
 
-        ret_code, _ = self.__run_batch(build_calls, {
+        return build_calls, {
             "source": source,
             "options": options,
             "size": size,
             "docker_name": make_safe_filename(make_safe_filename(self.description.get("name"), lower=True))
-        })
-        if ret_code:
-            raise RuntimeError("Singularity build failed (exit code {})".format(ret_code))
+        }
 
-        if self.dry_run:
-            self.eprint.bold("# Dry-run of building image {} complete.\n".format(self.imagefile))
-        else:
-            self.eprint.bold("# Successfully built image {}.\n".format(self.imagefile))
+    @entry_point
+    def run(self, overrides=None):
+        """Run built pipeline according to description.
 
-    def run(self):
-        """Run built pipeline according to description."""
+        overrides - substitutions taking precedence over the description's.
+        Runs with overrides bypass the step journal and up-to-date checks,
+        which are tracked per step regardless of substitutions."""
         self.eprint.bold("# Running pipeline...\n")
 
         if not self.dry_run:
             if not os.path.isfile(self.imagefile):
                 raise RuntimeError("Image {} does not exist".format(self.imagefile))
 
-            for spec in self.binds:
-                if not os.path.isdir(spec[0]):
+            for index, spec in enumerate(self.binds):
+                if self.bind_stages.get(index) != "out" and not os.path.exists(spec[0]):
                     raise RuntimeError("Bind source {} does not exist".format(spec[0]))
 
         commands = self.description.get("run").get("commands")
 
-        ret_code, step = self.__run_batch(commands)
+        if overrides:
+            with self.staged_binds(), self.persistent_instance():
+                ret_code, step = self.__run_batch(commands, overrides=overrides, stage="run",
+                                                  timeout=self.stage_timeouts.get("run"))
+        else:
+            with self.__journal() as journal, self.staged_binds(), self.persistent_instance():
+                ret_code, step = self.__run_batch(commands, incremental=True, stage="run", journal=journal,
+                                                  timeout=self.stage_timeouts.get("run"))
         if ret_code:
-            raise RuntimeError("Singularity run failed (step {}, exit code {})".format(step + 1, ret_code))
+            raise RuntimeError(failure_message("Singularity run failed", step, ret_code))
 
         if self.dry_run:
             self.eprint.bold("# Dry-run of running image {} complete.\n".format(self.imagefile))
         else:
             self.eprint.bold("# Successfully ran {}.\n".format(self.description.get("name")))
 
-    def test(self, force=False, skip_run=False):
-        """Run defined tests against the pipeline according to description."""
-        self.eprint.bold("# Testing pipeline...\n")
+    @entry_point
+    def test(self, force=False, skip_run=False, update_checksums=False, skip_prepare=False):
+        """Run defined tests against the pipeline according to description.
+
+        update_checksums - regenerate test.checksums from current outputs instead of verifying them.
+        skip_prepare - assume test files were already prepared (see prepare_test()).
+
+        With staged binds, the instance is started by run() instead, so that it
+        sees the scratch copies while validation sees the synced-back results."""
+        with self.persistent_instance(enabled=not self.bind_stages):
+            self.eprint.bold("# Testing pipeline...\n")
+
+            if not skip_prepare:
+                self.prepare_test(force=force)
+
+            if skip_run:
+                self.eprint.bold("# Skipping run stage.\n")
+            else:
+                self.run()
+
+            self.eprint.bold("# Running validation stage...\n")
+
+            checksums = self.description.get("test").get("checksums")
+            if checksums:
+                if update_checksums:
+                    self.__update_checksums(checksums)
+                else:
+                    self.__verify_checksums(checksums)
+
+            test_validate = self.description.get("test").get("validate_commands")
+            if test_validate is not None or not checksums:
+                ret_code, step = self.__run_batch(test_validate, stage="validate",
+                                                  timeout=self.stage_timeouts.get("test"))
+                if ret_code:
+                    raise RuntimeError(failure_message("Singularity test validation failed", step, ret_code))
+
+            if self.dry_run:
+                self.eprint.bold("# Dry-run of validating image {} complete.\n".format(self.imagefile))
+            else:
+                self.eprint.bold("# Pipeline {} validated successfully!\n".format(self.imagefile))
 
+    @entry_point
+    def prepare_test(self, force=False):
+        """Run test prepare commands if any test file is missing, or if forced."""
         test_files = self.description.get("test").get("test_files")
 
         if not self.__check_files_exist(test_files) or force:
             self.eprint.bold("(Re)creating test files...")
 
             test_prepare = self.description.get("test").get("prepare_commands")
-            ret_code, step = self.__run_batch(test_prepare)
+            ret_code, step = self.__run_batch(test_prepare, stage="prepare", timeout=self.stage_timeouts.get("test"))
+            if ret_code:
+                raise RuntimeError(failure_message("Test preparation failed", step, ret_code))
 
             if not self.dry_run and not self.__check_files_exist(test_files):
                 raise RuntimeError("Test files not generated by prepare commands")
         else:
             self.eprint.yellow("Test files already exist and will be reused.\n")
 
-        if skip_run:
-            self.eprint.bold("# Skipping run stage.\n")
-        else:
-            self.run()
+    @entry_point
+    def build_and_test(self, force=False, skip_run=False, update_checksums=False):
+        """Build the image and prepare test files concurrently, then run and validate.
 
-        self.eprint.bold("# Running validation stage...\n")
+        If either side fails (or on KeyboardInterrupt), the other is cancelled
+        and the first error is raised."""
+        if self.dry_run:
+            self.build(force=force)
+            self.prepare_test(force=force)
+        else:
+            errors = []
+
+            def guarded(func, **kwargs):
+                try:
+                    func(**kwargs)
+                except BaseException as e:  # Re-raised in the calling thread
+                    errors.append(e)
+                    self.cancel()
+
+            threads = [
+                threading.Thread(target=guarded, args=(self.build,), kwargs={"force": force}),
+                threading.Thread(target=guarded, args=(self.prepare_test,), kwargs={"force": force})
+            ]
+            for thread in threads:
+                thread.daemon = True
+                thread.start()
+            try:
+                for thread in threads:
+                    while thread.is_alive():
+                        thread.join(0.5)  # Keep the main thread responsive to KeyboardInterrupt
+            except BaseException:
+                self.cancel()
+                for thread in threads:
+                    thread.join()
+                raise
+            if errors:
+                raise errors[0]
+
+        self.test(skip_run=skip_run, update_checksums=update_checksums, skip_prepare=True)
+
+    def cancel(self):
+        """Stop starting new steps and terminate running local step processes."""
+        self.cancel_event.set()
+        self.processes.terminate()
+
+    def clone(self, eprint=None):
+        """Return a copy sharing the loaded description, plan and warm instance, with its own run state.
+
+        The copy has fresh staged bind overrides, cancellation, process
+        registry, executor and report, so it can run next to the original."""
+        clone = copy.copy(self)
+        if eprint is not None:
+            clone.eprint = eprint
+        clone.bind_overrides = {}
+        clone.cancel_event = threading.Event()
+        clone.entry_lock = threading.Lock()
+        clone.entries = 0
+        clone.processes = ProcessRegistry()
+        clone.executor = self.executor.clone(clone.processes, clone.cancel_event)
+        if self.report is not None:
+            clone.report = Report(**dict((key, self.report.metadata[key]) for key in ["pipeline", "version", "image"]))
+        return clone
+
+    def build_async(self, force=False):
+        """Awaitable build() running on the event loop's default executor (Python 3)."""
+        return self.__in_executor(self.build, force=force)
+
+    def run_async(self, overrides=None):
+        """Awaitable run() running on the event loop's default executor (Python 3)."""
+        return self.__in_executor(self.run, overrides=overrides)
+
+    def test_async(self, force=False, skip_run=False, update_checksums=False):
+        """Awaitable test() running on the event loop's default executor (Python 3)."""
+        return self.__in_executor(self.test, force=force, skip_run=skip_run, update_checksums=update_checksums)
+
+    def __in_executor(self, func, **kwargs):
+        """Run func in a thread of the current asyncio event loop, returning a future.
+
+        Several pipelines can be awaited concurrently in one loop; cancelling
+        the future cancels the pipeline (see cancel())."""
+        import asyncio  # Not available on Python 2
+        try:
+            loop = asyncio.get_running_loop()
+        except (AttributeError, RuntimeError):  # Python < 3.7, or no loop running yet
+            loop = asyncio.get_event_loop()
+        future = loop.run_in_executor(None, functools.partial(func, **kwargs))
+        future.add_done_callback(lambda done: self.cancel() if done.cancelled() else None)
+        return future
+
+    def __verify_checksums(self, spec):
+        """Verify test.checksums in-process, reporting all mismatches at once."""
+        try:
+            entries, _ = load_checksums(spec)
+        except FormatError as e:
+            raise RuntimeError(str(e))
 
-        test_validate = self.description.get("test").get("validate_commands")
-        ret_code, step = self.__run_batch(test_validate)
-        if ret_code:
-            raise RuntimeError("Singularity test validation failed (step {}, exit code {})".format(step + 1, ret_code))
+        if self.dry_run:
+            self.eprint.yellow("DRY RUN: Would verify checksums of {} files.\n".format(len(entries)))
+            return
+
+        mismatches = verify_checksums(entries)
+        for name, expected, actual in mismatches:
+            if actual is None:
+                self.eprint.red("MISSING  {}".format(name))
+            else:
+                self.eprint.red("MISMATCH {} (expected {}, got {})".format(name, expected, actual))
+        if mismatches:
+            raise RuntimeError("Checksum validation failed for {} of {} files".format(len(mismatches), len(entries)))
+        self.eprint.normal("Checksums of {} files verified.\n".format(len(entries)))
+
+    def __update_checksums(self, spec):
+        """Recompute test.checksums from current outputs and write them back."""
+        try:
+            entries, checksum_file = load_checksums(spec)
+        except FormatError as e:
+            raise RuntimeError(str(e))
+        if not entries:
+            raise RuntimeError("No files listed in test checksums")
 
         if self.dry_run:
-            self.eprint.bold("# Dry-run of validating image {} complete.\n".format(self.imagefile))
+            self.eprint.yellow("DRY RUN: Would update checksums of {} files.\n".format(len(entries)))
+            return
+
+        updated = compute_checksums(entries)
+        missing = [name for name in sorted(updated) if updated[name] is None]
+        if missing:
+            raise RuntimeError("Cannot update checksums, missing files: {}".format(", ".join(missing)))
+
+        if checksum_file:
+            write_checksum_file(checksum_file, updated)
+            self.eprint.bold("Checksums of {} files written to {}.\n".format(len(updated), checksum_file))
         else:
-            self.eprint.bold("# Pipeline {} validated successfully!\n".format(self.imagefile))
+            self.eprint.yellow("Checksums are inline in the description; update test.checksums with:\n")
+            self.eprint.normal(yaml.safe_dump({"checksums": updated}, default_flow_style=False))
+        self.__event("checksums.updated", checksums=updated, file=checksum_file)
+
+    @entry_point
+    def sweep(self, rows, workers=1):
+        """Run the pipeline's run commands once per substitution row.
+
+        rows    - list of dicts overriding substitutions for each run
+        workers - maximum number of rows to run concurrently
 
-    def __run_batch(self, commands, substitutions={}):
-        if not isinstance(commands, list):
-            raise FormatError("Run commands must be a list")
+        Failed rows do not stop the others. Returns a list of
+        (row, exit code, failed Step or None) in row order."""
+        self.eprint.bold("# Sweeping pipeline over {} rows...\n".format(len(rows)))
+
+        if not self.dry_run and not os.path.isfile(self.imagefile):
+            raise RuntimeError("Image {} does not exist".format(self.imagefile))
+
+        commands = self.description.get("run").get("commands")
+
+        def run_row(row):
+            ret_code, step = self.__run_batch(commands, overrides=row, stage="run",
+                                              timeout=self.stage_timeouts.get("run"))
+            return row, ret_code, step
+
+        with self.persistent_instance():
+            results = map_concurrently(run_row, rows, workers=1 if self.dry_run else workers)
+
+        self.eprint.bold("# Sweep summary:\n")
+        for index, (row, ret_code, step) in enumerate(results):
+            if ret_code:
+                self.eprint.red(failure_message("FAILED " + row_label(index, row), step, ret_code))
+            else:
+                self.eprint.normal("OK     {}".format(row_label(index, row)))
+
+        failed = len([result for result in results if result[1]])
+        if failed:
+            raise RuntimeError("Sweep failed for {} of {} rows".format(failed, len(results)))
+        self.eprint.bold("\n# All {} sweep rows completed successfully.\n".format(len(results)))
+        return results
+
+    def __run_batch(self, commands, substitutions={}, incremental=False, overrides={}, stage="run", journal=None,
+                    timeout=None):
+        """Run a list of commands (or step descriptions), respecting step dependencies.
+
+        substitutions - extra substitutions, overridden by the description's
+        incremental - skip steps whose declared outputs are up to date.
+        overrides - substitutions taking precedence over the description's
+        stage - stage name (build, run, prepare, validate) used in reports
+        journal - Journal recording step progress, and skipping completed steps when resuming
+        timeout - seconds the whole batch may take; steps get at most the remaining time
+
+        Returns (exit code, failed Step), or (0, None) if all steps succeeded."""
+        steps = parse_steps(commands)
+        state = StepState(self.imagefile + STEP_STATE_SUFFIX, self.check_mode) if incremental else None
 
         subs = self.substitution_dictionary(**substitutions)
-        if self.description.get("substitutions"):
-            subs.update(self.description.get("substitutions"))
+        subs.update(overrides)
+        stable_subs = self.substitution_dictionary(stable=True, **substitutions)  # For up-to-date and resume checks
+        stable_subs.update(overrides)
+        subs_hash = data_digest(stable_subs)
+
+        # Format every step before running any, so a bad placeholder fails fast
+        formatted = {}  # Step index -> (command, inputs, outputs) with the step's own cpus, reused by launch()
+        try:
+            for step in steps:
+                formatted[step.index] = format_step(step, subs, step.cpus)
+                if step.foreach is not None:
+                    expand_items(step, subs)
+                if step.gather is not None:
+                    format_gather(step, subs, step.cpus)
+        except FormatError as e:
+            raise RuntimeError("Cannot format {} commands: {}".format(stage, e))
+        variant = data_digest(overrides)[:8] if overrides else None  # Tells sweep rows' files apart
+        usage = []
+        deadline = time.time() + timeout if timeout else None
 
         action = "Executing"
         if self.dry_run:
             action = "Displaying"
             self.eprint.yellow("DRY RUN: Commands only displayed, not run.\n")
 
-        for step, command in enumerate(commands):
-            command = command.format(**subs)
-            self.eprint.bold("{action} step {step}:\n  {command}\n".format(
-                action=action,
-                step=step + 1,
-                command=command
-            ))
-            if not self.dry_run:
-                ret_code = subprocess.call(command, shell=True)
-                if ret_code:
-                    return ret_code, step + 1  # Failure code + step number
+        # Batch executors only take the run stage; build and test stages stay on this host
+        executor = self.executor
+        if not executor.local and stage != "run":
+            executor = SerialExecutor(self.budget, self.processes)
+
+        def launch(step):
+            if self.cancel_event.is_set():
+                return CANCELLED
+            cpus, memory = executor.assign(step)
+            if cpus == step.cpus:
+                command, inputs, outputs = formatted[step.index]
+            else:  # Clamped to the budget: {threads} differs
+                command, inputs, outputs = format_step(step, subs, cpus)
+
+            tracked = state is not None and bool(outputs) and step.foreach is None  # foreach: tracked per item
+            stable_command = format_step(step, stable_subs, cpus)[0] if journal or tracked else None
+            command_hash = data_digest(stable_command) if journal else None
+            if journal and journal.is_completed(step, command_hash, subs_hash):
+                self.eprint.yellow("Skipping step {step}: completed in a previous run.\n".format(step=step))
+                self.__event("step.skipped", stage=stage, step=step.key, reason="journal")
+                return 0
+
+            if tracked and step.key not in self.rebuild_steps and str(step.index + 1) not in self.rebuild_steps:
+                if self.__check_files_exist(outputs) and state.is_up_to_date(
+                    step.key, stable_command, inputs, outputs, self.imagefile
+                ):
+                    self.eprint.yellow("Skipping step {step}: outputs up to date.\n".format(step=step))
+                    self.__event("step.skipped", stage=stage, step=step.key, reason="up to date")
+                    return 0
+
+            items = None
+            if step.foreach is not None:
+                items = expand_items(step, subs)
+                self.eprint.bold("{action} step {step} for {count} items of {pattern}:\n  {command}{gather}\n".format(
+                    action=action,
+                    step=step,
+                    count=len(items),
+                    pattern=step.foreach.format(**subs) if not isinstance(step.foreach, list) else "list",
+                    command=command,
+                    gather="\n  then: " + format_gather(step, subs, cpus) if step.gather is not None else ""
+                ))
+            else:
+                self.eprint.bold("{action} step {step}:\n  {command}\n".format(
+                    action=action,
+                    step=step,
+                    command=command
+                ))
+            if self.dry_run:
+                return 0
+            step_timeout = step.timeout
+            if deadline is not None:
+                remaining = deadline - time.time()
+                if remaining <= 0:
+                    self.eprint.red("Stage {} timed out; step {} not started.".format(stage, step))
+                    step.timed_out = True
+                    return TIMEOUT_EXIT_CODE
+                step_timeout = min(step_timeout or remaining, remaining)
+
+            if journal:
+                journal.started(step, command_hash, subs_hash)
+            if items is not None:
+                ret_code = self.__run_foreach(step, stage, items, subs, stable_subs, (cpus, memory), state, variant,
+                                              step_timeout, execute)
+            else:
+                ret_code, step.output_tail, step.timed_out = execute(step, command, (cpus, memory), variant,
+                                                                     step_timeout)
+            if journal:
+                journal.finished(step, command_hash, subs_hash, ret_code)
+            if tracked and not ret_code:
+                state.record(step.key, stable_command, inputs, outputs, self.imagefile)
+            return ret_code
+
+        def execute(step, command, resources, step_variant, step_timeout, event="step", **fields):
+            """Run one formatted command; returns (exit code, output tail if failed, timed out)."""
+            self.__event(event + ".started", stage=stage, step=step.key, command=command, **fields)
+            sampler = None
+            if self.sample_interval and executor.local:
+                sampler = Sampler(self.sample_interval, log_filename(
+                    self.imagefile + SAMPLES_DIR_SUFFIX, stage, step, step_variant, extension=".tsv"
+                ))
+            with self.__step_output(stage, step, step_variant) as output:
+                ret_code, measurements = executor.execute(step, command, resources, output, step_timeout, sampler,
+                                                          step_variant)
+            measurements.update(fields)
+            if sampler and sampler.samples:
+                usage.append((step, measurements))
+            if measurements.get("timed_out"):
+                self.eprint.red("Step {}{} timed out after {:.1f}s and was terminated.".format(
+                    step, " item {}".format(fields["item"]) if "item" in fields else "", step_timeout
+                ))
+            if measurements.get("lost"):
+                self.eprint.red("Step {}{}: job {} ended ({}) without reporting an exit code.".format(
+                    step, " item {}".format(fields["item"]) if "item" in fields else "",
+                    measurements["job_id"], measurements["job_state"]
+                ))
+            tail = output.tail() if ret_code and output is not None else None
+            self.__event(event + ".finished", stage=stage, step=step.key, exit_code=ret_code,
+                         wall_time=measurements.get("wall_time"), tail=tail, **fields)
+            if self.report:
+                self.report.add(stage, step, command, ret_code, measurements)
+            return ret_code, tail, bool(measurements.get("timed_out"))
 
-        return 0, 0  # No failures
+        if self.dry_run:
+            return run_steps(steps, launch)
+
+        if not isinstance(executor, SerialExecutor):
+            self.eprint.normal("Running steps with {}.\n".format(executor))
+        try:
+            return executor.schedule(steps, launch)
+        finally:
+            if usage:
+                self.__print_usage(stage, usage)
+
+    def __run_foreach(self, step, stage, items, subs, stable_subs, resources, state, variant, timeout, execute):
+        """Run a foreach step's command for every item on a worker pool, then its gather command.
+
+        Items are handed to `step.workers` workers `step.batch` at a time, and
+        all of them run even if some fail; failed items are listed in
+        step.failed_items. Items whose outputs are up to date with the item
+        and declared inputs are skipped.
+        stable_subs are the substitutions for up-to-date checks, see substitution_dictionary().
+        Returns the exit code of the first failed item, or of the gather command."""
+        cpus, memory = resources
+        workers = self.budget.workers(step)
+        deadline = time.time() + timeout if timeout else None
+        rebuild = step.key in self.rebuild_steps or str(step.index + 1) in self.rebuild_steps
+        self.__event("step.started", stage=stage, step=step.key, command=step.command, items=len(items))
+        if not items:
+            self.eprint.yellow("Step {}: no items to process.\n".format(step))
+        elif workers > 1:
+            self.eprint.normal("Processing {} items with {} workers.\n".format(len(items), min(workers, len(items))))
+
+        def remaining():
+            return min(timeout, deadline - time.time()) if deadline is not None else None
+
+        def run_item(index):
+            item = items[index]
+            if self.cancel_event.is_set():
+                return CANCELLED, None, False
+            command, inputs, outputs = format_step(step, subs, cpus, item)
+            if item not in inputs:
+                inputs = [item] + inputs  # An item is always an input of its command
+            key = "{}:{}".format(step.key, item)
+            tracked = state is not None and bool(outputs)
+            stable_command = format_step(step, stable_subs, cpus, item)[0] if tracked else None
+            if tracked and not rebuild and self.__check_files_exist(outputs) and state.is_up_to_date(
+                key, stable_command, inputs, outputs, self.imagefile
+            ):
+                self.eprint.yellow("Skipping step {} item {}: outputs up to date.".format(step, item))
+                self.__event("item.skipped", stage=stage, step=step.key, item=item, reason="up to date")
+                return 0, None, False
+            if deadline is not None and remaining() <= 0:
+                return TIMEOUT_EXIT_CODE, None, True
+            self.eprint.normal("Step {} item {}/{}: {}".format(step, index + 1, len(items), item))
+            item_variant = "{}{}-{}".format(variant + "-" if variant else "", index + 1, os.path.basename(item))
+            ret_code, tail, timed_out = execute(step, command, resources, item_variant, remaining(),
+                                                event="item", item=item)
+            if tracked and not ret_code:
+                state.record(key, stable_command, inputs, outputs, self.imagefile)
+            return ret_code, tail, timed_out
+
+        def run_items(indices):
+            return [run_item(index) for index in indices]
+
+        batches = [range(start, min(start + step.batch, len(items))) for start in range(0, len(items), step.batch)]
+        results = [result for batch in map_concurrently(run_items, batches, workers=workers) for result in batch]
+
+        step.failed_items = [(item, result[0]) for item, result in zip(items, results) if result[0]]
+        failures = [result for result in results if result[0]]
+        ret_code = failures[0][0] if failures else 0
+        if failures:
+            step.output_tail, step.timed_out = failures[0][1], failures[0][2]
+            self.eprint.red("\nStep {}: {} of {} items failed:".format(step, len(failures), len(items)))
+            for item, code in step.failed_items:
+                self.eprint.red("  {} ({})".format(item, "timed out" if code == TIMEOUT_EXIT_CODE else
+                                                   "exit code {}".format(code)))
+        elif step.gather is not None:
+            command = format_gather(step, subs, cpus, items)
+            self.eprint.bold("Gathering step {step}:\n  {command}\n".format(step=step, command=command))
+            ret_code, step.output_tail, step.timed_out = execute(step, command, resources,
+                                                                 (variant + "-" if variant else "") + "gather",
+                                                                 remaining(), event="gather", gather=True)
+        self.__event("step.finished", stage=stage, step=step.key, exit_code=ret_code, items=len(items),
+                     failed_items=[item for item, _ in step.failed_items], tail=step.output_tail)
+        return ret_code
+
+    def __print_usage(self, stage, usage):
+        """Print peak and average resource use of sampled steps."""
+        self.eprint.bold("# Resource usage of {} steps (peak / average):".format(stage))
+        for step, measurements in sorted(usage, key=lambda entry: entry[0].index):
+            label = str(step)
+            if "item" in measurements:
+                label += " " + os.path.basename(measurements["item"])
+            self.eprint.normal("  {:<20} CPU {:>6.1f}% / {:>6.1f}%  RSS {:>6}B / {:>6}B  read {}B, written {}B".format(
+                label, measurements["cpu_percent_peak"], measurements["cpu_percent_avg"],
+                format_memory(measurements["rss_peak_kb"] * 1024), format_memory(measurements["rss_avg_kb"] * 1024),
+                format_memory(measurements["read_bytes"]), format_memory(measurements["write_bytes"])
+            ))
+        self.eprint.normal("Time series written to {}.\n".format(self.imagefile + SAMPLES_DIR_SUFFIX))
+
+    @contextlib.contextmanager
+    def __step_output(self, stage, step, variant):
+        """Capture a step's output as configured, yielding a StepOutput, or None to use the terminal."""
+        if not self.log_dir and not self.prefix_output:
+            yield None
+            return
+
+        path = None
+        if self.log_dir:
+            path = log_filename(self.log_dir, stage, step, variant, self.compress_logs)
+            self.eprint.normal("  Output logged to {}\n".format(path))
+        echo = None
+        if self.prefix_output:
+            prefix = "[{} {}]".format(stage, step.key)
+            echo = lambda text: self.eprint.prefixed(prefix, text)
+
+        with StepOutput(path, self.compress_logs, self.tail_lines, echo) as output:
+            yield output
+
+    def __event(self, name, **fields):
+        """Emit a structured event through EPrint's sinks."""
+        self.eprint.event(name, **fields)
+
+    @contextlib.contextmanager
+    def __journal(self):
+        """Open the run step journal next to the image, or yield None in dry-run mode."""
+        if self.dry_run:
+            yield None
+        else:
+            with Journal(self.imagefile + JOURNAL_SUFFIX, resume=self.resume) as journal:
+                yield journal
+
+    @contextlib.contextmanager
+    def staged_binds(self):
+        """Stage binds marked with `stage` through node-local scratch for the enclosed block.
+
+        Sources of `in`/`inout` binds are copied to scratch in parallel, bind
+        flags point to the scratch copies, and new or changed files of
+        `out`/`inout` binds are synced back on exit, including on failure.
+        Nested use reuses the staged copies."""
+        if not self.bind_stages or self.bind_overrides:
+            yield
+            return
+        if self.dry_run:
+            for index, mode in sorted(self.bind_stages.items()):
+                self.eprint.yellow("DRY RUN: Would stage bind {} ({}) through {}.".format(
+                    self.binds[index][0], mode, self.scratch
+                ))
+            yield
+            return
+
+        scratch_root = tempfile.mkdtemp(prefix="pipeline-", dir=self.scratch)
+        try:
+            for index, mode in sorted(self.bind_stages.items()):
+                source = self.binds[index][0]
+                scratch = os.path.join(scratch_root, str(index))
+                if os.path.isfile(source):
+                    os.makedirs(scratch)
+                    scratch = os.path.join(scratch, os.path.basename(source))
+                self.__record_staging(source, mode, "in", stage_in, source, scratch, mode)
+                self.bind_overrides[index] = scratch
+            yield
+        finally:
+            synced = True
+            for index, scratch in sorted(self.bind_overrides.items()):
+                source, mode = self.binds[index][0], self.bind_stages[index]
+                try:
+                    self.__record_staging(source, mode, "out", stage_out, scratch, source, mode)
+                except (IOError, OSError) as e:
+                    synced = False
+                    self.eprint.red("Failed to sync {} back to {}: {}".format(scratch, source, e))
+            self.bind_overrides = {}
+            if synced:
+                shutil.rmtree(scratch_root, ignore_errors=True)
+            else:
+                self.eprint.yellow("Scratch copies kept in {}.".format(scratch_root))
+
+    def __record_staging(self, bind, mode, direction, func, *args):
+        """Run a staging function, reporting files/bytes moved and time taken."""
+        started = time.time()
+        files, size = func(*args)
+        seconds = time.time() - started
+        if files:
+            self.eprint.normal("Staged {} bind {}: {} files, {}B in {:.1f}s.".format(
+                direction, bind, files, format_memory(size), seconds
+            ))
+        if self.report and mode in [direction, "inout"]:
+            self.report.metadata.setdefault("staging", []).append({
+                "bind": bind, "mode": mode, "direction": direction,
+                "files": files, "bytes": size, "seconds": round(seconds, 4)
+            })
+
+    @contextlib.contextmanager
+    def persistent_instance(self, enabled=True):
+        """Keep a single Singularity instance running for the enclosed block, if enabled.
+
+        While it runs, {exec} and {run} target the instance instead of starting
+        a fresh container for every step. The instance is always stopped on exit,
+        including on errors and KeyboardInterrupt. Nested use reuses the instance."""
+        if not self.use_instance or not enabled or self.instance_name:
+            yield
+            return
+
+        start_call, stop_call = instance_commands(check_singularity())
+        subs = self.substitution_dictionary(instance=make_instance_name(self.description.get("name")))
+
+        start_call = start_call.format(**subs)
+        self.eprint.bold("Starting persistent instance:\n  {}\n".format(start_call))
+        if not self.dry_run:
+            ret_code = subprocess.call(start_call, shell=True)
+            if ret_code:
+                raise RuntimeError("Singularity instance start failed (exit code {})".format(ret_code))
 
-    def check(self):
-        """Validate the pipeline description file."""
+        self.instance_name = subs["instance"]
+        try:
+            yield
+        finally:
+            self.instance_name = None
+            stop_call = stop_call.format(**subs)
+            self.eprint.bold("Stopping persistent instance:\n  {}\n".format(stop_call))
+            if not self.dry_run and subprocess.call(stop_call, shell=True):
+                self.eprint.yellow("Failed to stop instance {}; stop it manually.".format(subs["instance"]))
+
+    def check(self, known=()):
+        """Validate the pipeline description file.
+
+        Loading already compiled every command (see compile_plan()); this
+        reports steps using substitutions that are not defined, and bind
+        sources that do not exist.
+        known - substitution names supplied at run time, e.g. sweep matrix columns."""
         self.eprint.bold("# Checking pipeline file!\n")
 
-        raise NotImplementedError("Checking still in the works.")
+        for stage in self.plan.order:
+            self.eprint.normal("{}: {} step(s)".format(stage, len(self.plan.stages[stage])))
+
+        for index, spec in enumerate(self.binds):
+            if self.bind_stages.get(index) != "out" and not os.path.exists(spec[0]):
+                self.eprint.yellow("Bind source {} does not exist".format(spec[0]))
 
-    def __bind_flags(self):
+        unresolved = self.plan.unresolved(known)
+        for stage, entry, names in unresolved:
+            self.eprint.red("{} step {} uses unknown substitution(s): {}".format(
+                stage, entry["step"], ", ".join("{" + name + "}" for name in names)
+            ))
+        if unresolved:
+            raise RuntimeError("{} step(s) use unknown substitutions".format(len(unresolved)))
+
+        self.eprint.bold("\n# Pipeline description {} is valid.\n".format(self.description.get("name")))
+
+    def __bind_flags(self, stable=False):
         """Return all bind flags for singularity as a string.
 
+        stable - use the original sources of staged binds, not their scratch copies.
         Will contain trailing space if non-empty."""
         bind_flags = ""
         if len(self.binds):
-            for spec in self.binds:
-                bind_flags += "-B {source}:{dest} ".format(source=spec[0], dest=spec[1])
+            for index, spec in enumerate(self.binds):
+                source = spec[0] if stable else self.bind_overrides.get(index, spec[0])
+                bind_flags += "-B {source}:{dest} ".format(source=source, dest=spec[1])
 
         return bind_flags
 
     def check_binds_exist(self):
         """Check that all source folders in binds exist."""
-        binds = list(self.description.get("binds"))
-
-        if binds is not None:
-            return self.__check_files_exist(
-                [bind.split(":")[0] for bind in binds]
-            )
+        return self.__check_files_exist([spec[0] for spec in self.binds])
 
     def __check_files_exist(self, file_list):
         """Check that a list of files/folders exists."""
@@ -252,26 +1086,48 @@ class Pipeline():
                 return False
         return True
 
-    def substitution_dictionary(self, **extra):
+    def substitution_dictionary(self, stable=False, **extra):
         """Compile a dictionary of substitutions to be passed to .format() for shell commands.
 
-        extra - Addidtional substitutions to include.
+        stable - ignore the persistent instance and scratch copies of staged binds,
+                 whose names change with every run; commands formatted this way
+                 identify steps across runs.
+        extra - Addidtional substitutions to include, overridden by the description's.
         """
         subs = extra.copy()
 
-        if self.description.get("substitutions"):
-            subs.update(self.description.get("substitutions"))
-
         subs["image"] = self.imagefile
 
-        subs["binds"] = self.__bind_flags()
+        subs["binds"] = self.__bind_flags(stable)
+
+        if self.instance_name and not stable:
+            subs["exec"] = "singularity exec instance://{}".format(self.instance_name)
+            subs["run"] = "singularity run instance://{}".format(self.instance_name)
+        else:
+            subs["exec"] = "singularity exec {binds}{image}".format(**subs)
+            subs["run"] = "singularity run {binds}{image}".format(**subs)
 
-        subs["exec"] = "singularity exec {binds}{image}".format(**subs)
-        subs["run"] = "singularity run {binds}{image}".format(**subs)
+        if self.description.get("substitutions"):
+            subs.update(self.description.get("substitutions"))
 
         return subs
 
 
+def failure_message(message, step, ret_code):
+    """Describe a failed step, followed by the last lines of its output if captured."""
+    if step.timed_out:
+        message = "{} (step {}, timed out)".format(message, step)
+    else:
+        message = "{} (step {}, exit code {})".format(message, step, ret_code)
+    if step.failed_items:
+        message += "; {} item(s) failed: {}".format(len(step.failed_items), ", ".join(
+            item for item, _ in step.failed_items[:10]
+        ) + (", ..." if len(step.failed_items) > 10 else ""))
+    if step.output_tail:
+        message += "; last lines of output:\n" + "\n".join("  " + line for line in step.output_tail)
+    return message
+
+
 def check_singularity():
     """Check that Singularity is installed and is of >= SUPPORTED_VERSION version"""
     def to_int(s):
@@ -290,7 +1146,7 @@ def check_singularity():
         return test_array >= target_array
 
     try:
-        version = subprocess.check_output(["singularity", "--version"]).strip().decode("utf-8")
+        version = singularity_version()
         if not compare_version(version, SUPPORTED_VERSION):
             raise ToolError("Singularity version {} is less than minimum supported ({})".format(version, SUPPORTED_VERSION))
         return version
@@ -302,42 +1158,95 @@ def check_singularity():
         raise ToolError("Unexpected format for Singularity version string ({})".format(version))
 
 
-def make_safe_filename(name, lower=False):
-    """Convert filename-unsafe characters to '_'.
+_version_cache = {}
 
-    Parameter:
-    lower (bool) - whether to lowercase the filename."""
-    safe = string.ascii_letters + string.digits + "_-./"
-    if lower:
-        name = name.lower()
-    return "".join(map(lambda c: c if (c in safe) else '_', name))
 
+def singularity_version():
+    """Return the output of `singularity --version`, probing at most once per binary.
 
-class LoadError(RuntimeError):
-    """Exception class for failed file load or parse."""
+    Results are memoized per process and cached on disk, keyed by the
+    resolved binary path and its mtime, so upgrades are picked up."""
+    binary = find_executable("singularity")
+    if not binary:
+        raise OSError(errno.ENOENT, "singularity: command not found")
+    key = "{}:{}".format(binary, os.path.getmtime(binary))
 
-    pass
+    if key not in _version_cache:
+        cache_file = os.path.join(cache_directory(), VERSION_CACHE_FILE)
+        try:
+            with open(cache_file) as f:
+                disk_cache = json.load(f)
+        except (IOError, ValueError):
+            disk_cache = {}
+
+        if key in disk_cache:
+            _version_cache[key] = disk_cache[key]
+        else:
+            _version_cache[key] = subprocess.check_output([binary, "--version"]).strip().decode("utf-8")
+            disk_cache = dict((k, v) for k, v in disk_cache.items() if not k.startswith(binary + ":"))
+            disk_cache[key] = _version_cache[key]
+            try:
+                ensure_directory(os.path.dirname(cache_file))
+                with open(cache_file, "w") as f:
+                    json.dump(disk_cache, f)
+            except (IOError, OSError):
+                pass  # Caching is best-effort
+
+    return _version_cache[key]
+
+
+def cache_directory():
+    """Per-user cache directory of singularity-pipeline."""
+    return os.path.join(
+        os.environ.get("XDG_CACHE_HOME") or os.path.join(os.path.expanduser("~"), ".cache"),
+        "singularity-pipeline"
+    )
+
+
+def find_executable(name):
+    """Resolve an executable on PATH to its real path, or None if not found."""
+    for directory in os.environ.get("PATH", os.defpath).split(os.pathsep):
+        path = os.path.join(directory, name)
+        if os.path.isfile(path) and os.access(path, os.X_OK):
+            return os.path.realpath(path)
+    return None
+
+
+def read_fingerprint(path):
+    """Return the fingerprint stored in a file, or None if unavailable."""
+    try:
+        with open(path) as f:
+            return f.read().strip()
+    except IOError:
+        return None
 
 
-class FormatError(ValueError):
-    """Exception class for non-conforming file format."""
+def singularity_major(version):
+    """Major version number from a Singularity version string, 0 if unparseable."""
+    major = re.match(r"\D*(\d+)", version)
+    return int(major.group(1)) if major else 0
 
-    def __init__(self, error):
-        """Store specific error description."""
-        self.error = error
 
-    def __str__(self):
-        """Print out specific error description as string representation."""
-        return self.error
+def instance_commands(version):
+    """Return (start, stop) command templates for persistent instances.
 
+    Singularity 2.x uses `instance.start`/`instance.stop`, 3.x uses subcommands."""
+    if singularity_major(version) >= 3:
+        return "singularity instance start {binds}{image} {instance}", "singularity instance stop {instance}"
+    return "singularity instance.start {binds}{image} {instance}", "singularity instance.stop {instance}"
 
-class ToolError(RuntimeError):
-    """Exception class for unexpected response from external tools."""
 
-    def __init__(self, error):
-        """Store specific error description."""
-        self.error = error
+def make_instance_name(name):
+    """Build a unique, Singularity-safe instance name: <name>_<pid>_<number started by this process>."""
+    return "{}_{}_{}".format(re.sub("[^a-z0-9_]", "_", str(name).lower()), os.getpid(), next(_instance_numbers))
+
+
+def make_safe_filename(name, lower=False):
+    """Convert filename-unsafe characters to '_'.
 
-    def __str__(self):
-        """Print out specific error description as string representation."""
-        return self.error
+    Parameter:
+    lower (bool) - whether to lowercase the filename."""
+    safe = string.ascii_letters + string.digits + "_-./"
+    if lower:
+        name = name.lower()
+    return "".join(map(lambda c: c if (c in safe) else '_', name))
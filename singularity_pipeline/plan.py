@@ -0,0 +1,175 @@
+"""Compiled execution plans: the steps of every stage with their commands formatted up front."""
+
+import glob
+import os
+import re
+import string
+
+try:
+    from shlex import quote  # Python 3
+except ImportError:
+    from pipes import quote
+
+from .errors import FormatError
+from .steps import parse_steps, topological_order
+
+
+def template_fields(template):
+    """Return the set of substitution names used by a command template.
+
+    Raises FormatError if the template is malformed or uses positional fields."""
+    fields = set()
+    try:
+        parsed = list(string.Formatter().parse(template))
+    except ValueError as e:
+        raise FormatError("Malformed command '{}': {}".format(template, e))
+    for _, field, _, _ in parsed:
+        if field is None:
+            continue
+        name = re.split(r"[.\[]", field)[0]
+        if not name or name.isdigit():
+            raise FormatError("Positional placeholder in command '{}'; use {{{{ }}}} for literal braces".format(
+                template
+            ))
+        fields.add(name)
+    return fields
+
+
+ITEM_FIELDS = ["item", "item_stem"]  # Substitutions of foreach steps, set per item
+
+
+def item_substitutions(item):
+    """{item} and {item_stem} (file name without directory and last extension) of a foreach item.
+
+    Without an item, they are kept as placeholders for display."""
+    if item is None:
+        return dict((field, "{" + field + "}") for field in ITEM_FIELDS)
+    return {"item": item, "item_stem": os.path.splitext(os.path.basename(item))[0]}
+
+
+def expand_items(step, subs):
+    """Return the items of a foreach step: its list, or the sorted matches of its glob."""
+    try:
+        if isinstance(step.foreach, list):
+            return [item.format(**subs) for item in step.foreach]
+        return sorted(glob.glob(step.foreach.format(**subs)))
+    except KeyError as e:
+        raise FormatError("Step {} uses unknown substitution {{{}}}".format(step, e.args[0]))
+    except (IndexError, ValueError, AttributeError) as e:
+        raise FormatError("Cannot format step {}: {}".format(step, e))
+
+
+def format_step(step, subs, cpus, item=None):
+    """Format a step's command, inputs and outputs; returns (command, inputs, outputs).
+
+    {threads} is the step's assigned cpus, unless the description defines
+    `threads` and the step declares no cpus. For foreach steps, item sets
+    {item} and {item_stem}. Raises FormatError naming the step."""
+    if "cpus" in step.spec or "threads" not in subs:
+        subs = dict(subs, threads=cpus)
+    if step.foreach is not None:
+        subs = dict(subs, **item_substitutions(item))
+    try:
+        return (
+            step.command.format(**subs),
+            [path.format(**subs) for path in step.spec.get("inputs", [])],
+            [path.format(**subs) for path in step.spec.get("outputs", [])]
+        )
+    except KeyError as e:
+        raise FormatError("Step {} uses unknown substitution {{{}}}".format(step, e.args[0]))
+    except (IndexError, ValueError, AttributeError) as e:
+        raise FormatError("Cannot format step {}: {}".format(step, e))
+
+
+def format_gather(step, subs, cpus, items=None):
+    """Format the gather command of a foreach step, with {items} the shell-quoted items.
+
+    {threads} follows format_step. Without items, {items} is kept as a placeholder for display."""
+    if "cpus" in step.spec or "threads" not in subs:
+        subs = dict(subs, threads=cpus)
+    try:
+        return step.gather.format(**dict(subs, items=" ".join(quote(item) for item in items)
+                                          if items is not None else "{items}"))
+    except KeyError as e:
+        raise FormatError("Step {} gather uses unknown substitution {{{}}}".format(step, e.args[0]))
+    except (IndexError, ValueError, AttributeError) as e:
+        raise FormatError("Cannot format gather of step {}: {}".format(step, e))
+
+
+class Plan():
+    """Steps of all stages, compiled against the description's substitutions.
+
+    Stages are "build", "prepare", "run" and "validate"; each maps to a list of
+    compact step dicts in dependency order. Steps using substitutions that are
+    only known at run time (e.g. sweep matrix columns) keep their template and
+    list them under `unresolved`."""
+
+    def __init__(self, substitutions):
+        """Initialize an empty plan for the resolved substitutions."""
+        self.substitutions = substitutions
+        self.stages = {}
+        self.order = []
+
+    def add_stage(self, stage, commands, extra=None):
+        """Compile a stage's commands (a list of strings or step mappings).
+
+        extra - stage-specific substitutions, e.g. the build's {source}."""
+        subs = dict(extra or {}, **self.substitutions)
+        steps = parse_steps(commands)
+        by_index = dict((step.index, step) for step in steps)
+
+        compiled = []
+        for step in topological_order(steps):
+            fields = template_fields(step.command)
+            for path in step.spec.get("inputs", []) + step.spec.get("outputs", []):
+                fields |= template_fields(path)
+            if step.foreach is not None:
+                fields -= set(ITEM_FIELDS)
+                for pattern in step.foreach if isinstance(step.foreach, list) else [step.foreach]:
+                    fields |= template_fields(pattern)
+                if step.gather is not None:
+                    fields |= template_fields(step.gather) - set(["items"])
+            unresolved = sorted(fields - set(subs) - set(["threads"]))
+
+            entry = {"step": step.key, "number": step.index + 1}
+            if step.depends_on:
+                entry["depends_on"] = [by_index[dep].key for dep in step.depends_on]
+            if unresolved:
+                entry["template"] = step.command
+                entry["unresolved"] = unresolved
+            else:
+                entry["command"], inputs, outputs = format_step(step, subs, step.cpus)
+                if inputs:
+                    entry["inputs"] = inputs
+                if outputs:
+                    entry["outputs"] = outputs
+                if step.gather is not None:
+                    entry["gather"] = format_gather(step, subs, step.cpus)
+            for attribute in ["cpus", "memory", "timeout", "foreach", "batch", "workers"]:
+                if attribute in step.spec:
+                    entry[attribute] = getattr(step, attribute)
+            compiled.append(entry)
+
+        self.stages[stage] = compiled
+        self.order.append(stage)
+
+    def steps(self):
+        """Iterate over (stage, step dict) pairs in stage order."""
+        for stage in self.order:
+            for entry in self.stages[stage]:
+                yield stage, entry
+
+    def unresolved(self, known=()):
+        """Return (stage, step dict, names) for steps using substitutions not in known."""
+        return [
+            (stage, entry, [name for name in entry["unresolved"] if name not in known])
+            for stage, entry in self.steps()
+            if [name for name in entry.get("unresolved", []) if name not in known]
+        ]
+
+    def to_dict(self):
+        """The plan as a JSON-serializable dict."""
+        return {
+            "substitutions": self.substitutions,
+            "stages": [{"stage": stage, "steps": self.stages[stage]} for stage in self.order]
+        }
@@ -0,0 +1,196 @@
+"""Per-step timing and resource reports, and comparison between reports."""
+
+import json
+import os
+import signal
+import subprocess
+import threading
+import time
+
+TIMEOUT_EXIT_CODE = 124  # Exit code reported for timed out steps, as by coreutils' `timeout`
+KILL_GRACE = 10  # Seconds between SIGTERM and SIGKILL for timed out steps
+
+
+def run_command(command, registry=None, output=None, timeout=None, sampler=None):
+    """Run a shell command, returning (exit code, measurements).
+
+    Measurements come from the child's own rusage (via wait4), so they stay
+    per-step even when several steps run concurrently.
+    registry - ProcessRegistry tracking the process while it runs, for cancellation.
+    output   - StepOutput receiving stdout and stderr line by line; if None,
+               the command inherits the terminal.
+    timeout  - seconds after which the command and its descendants are terminated
+               (killed if still running KILL_GRACE seconds later); the exit code
+               is then TIMEOUT_EXIT_CODE and measurements include `timed_out`.
+    sampler  - Sampler following the process tree while it runs; its summary
+               is added to the measurements."""
+    started = time.time()
+    if output is None:
+        process = subprocess.Popen(command, shell=True)
+    else:
+        process = subprocess.Popen(command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.STDOUT)
+    if registry is not None:
+        registry.add(process)
+    if sampler is not None:
+        sampler.start(process.pid)
+
+    timed_out = threading.Event()
+    exited = threading.Event()
+    timer = None
+    if timeout is not None:
+        def expire():
+            timed_out.set()
+            terminate_tree(process.pid)
+            if not exited.wait(KILL_GRACE):
+                terminate_tree(process.pid, signal.SIGKILL)
+        timer = threading.Timer(timeout, expire)
+        timer.daemon = True
+        timer.start()
+
+    try:
+        if output is not None:
+            with process.stdout:
+                output.feed(process.stdout)
+        _, status, usage = os.wait4(process.pid, 0)
+    except BaseException:
+        process.wait()  # Reap the child, e.g. after KeyboardInterrupt
+        raise
+    finally:
+        exited.set()
+        if timer is not None:
+            timer.cancel()
+        if sampler is not None:
+            sampler.stop()
+        if registry is not None:
+            registry.remove(process)
+    wall_time = time.time() - started
+
+    if os.WIFSIGNALED(status):
+        ret_code = -os.WTERMSIG(status)
+    else:
+        ret_code = os.WEXITSTATUS(status)
+    process.returncode = ret_code
+
+    measurements = {
+        "started": started,
+        "wall_time": round(wall_time, 4),
+        "user_time": round(usage.ru_utime, 4),
+        "system_time": round(usage.ru_stime, 4),
+        "max_rss_kb": usage.ru_maxrss
+    }
+    if sampler is not None:
+        measurements.update(sampler.summary())
+    if timed_out.is_set():
+        ret_code = TIMEOUT_EXIT_CODE
+        measurements["timed_out"] = True
+    return ret_code, measurements
+
+
+class ProcessRegistry():
+    """Running step processes, which can be terminated together."""
+
+    def __init__(self):
+        """Initialize an empty registry."""
+        self.processes = set()
+        self.lock = threading.Lock()
+
+    def add(self, process):
+        """Track a started process."""
+        with self.lock:
+            self.processes.add(process)
+
+    def remove(self, process):
+        """Stop tracking a finished process."""
+        with self.lock:
+            self.processes.discard(process)
+
+    def terminate(self):
+        """Send SIGTERM to all tracked processes and their descendants."""
+        with self.lock:
+            pids = [process.pid for process in self.processes]
+        for pid in pids:
+            terminate_tree(pid)
+
+
+def process_tree(pid):
+    """Return pid followed by the pids of all its descendants, found via /proc."""
+    tree = [pid]
+    for parent in tree:  # Grows while iterating
+        try:
+            for task in os.listdir("/proc/{}/task".format(parent)):
+                with open("/proc/{}/task/{}/children".format(parent, task)) as f:
+                    tree.extend(int(child) for child in f.read().split())
+        except (IOError, OSError):
+            pass
+    return tree
+
+
+def terminate_tree(pid, sig=signal.SIGTERM):
+    """Signal a process and all its descendants, found via /proc."""
+    for member in process_tree(pid):
+        try:
+            os.kill(member, sig)
+        except OSError:
+            pass  # Already gone
+
+
+class Report():
+    """Thread-safe collection of step measurements, saved as JSON."""
+
+    def __init__(self, **metadata):
+        """Initialize an empty report; metadata is stored alongside the steps."""
+        self.metadata = metadata
+        self.steps = []
+        self.lock = threading.Lock()
+
+    def add(self, stage, step, command, ret_code, measurements):
+        """Record one executed step."""
+        record = {
+            "stage": stage,
+            "step": step.key,
+            "command": command,
+            "exit_code": ret_code
+        }
+        record.update(measurements)
+        with self.lock:
+            self.steps.append(record)
+
+    def save(self, path):
+        """Write the report to path as JSON."""
+        data = dict(self.metadata)
+        with self.lock:
+            data["steps"] = list(self.steps)
+        with open(path, "w") as f:
+            json.dump(data, f, indent=1, sort_keys=True)
+
+
+def load_report(path):
+    """Load a report saved by Report.save()."""
+    with open(path) as f:
+        return json.load(f)
+
+
+def compare_reports(old, new, threshold=0.2, min_seconds=1.0):
+    """Compare wall times of steps present in both reports.
+
+    A step is flagged as a regression if it got slower by more than
+    `threshold` (a fraction) and by at least `min_seconds`.
+    Returns a list of (stage, step, old wall time, new wall time, flagged)."""
+    def label(record):
+        # Items of foreach steps are compared one by one
+        return record["step"] if "item" not in record else "{} [{}]".format(record["step"], record["item"])
+
+    def by_key(report):
+        # Last record wins if a step ran several times (e.g. run inside test)
+        return dict(((record["stage"], label(record)), record) for record in report.get("steps", []))
+
+    old_steps = by_key(old)
+    rows = []
+    for key, record in sorted(by_key(new).items()):
+        if key not in old_steps:
+            continue
+        old_time = old_steps[key]["wall_time"]
+        new_time = record["wall_time"]
+        flagged = new_time > old_time * (1 + threshold) and new_time - old_time >= min_seconds
+        rows.append((key[0], key[1], old_time, new_time, flagged))
+    return rows
@@ -0,0 +1,169 @@
+"""Host resource budget detection and step resource hints."""
+
+import multiprocessing
+import os
+import re
+
+from .errors import FormatError
+
+MEMORY_UNITS = {"": 1, "K": 1024, "M": 1024 ** 2, "G": 1024 ** 3, "T": 1024 ** 4}
+DURATION_UNITS = {"": 1, "s": 1, "m": 60, "h": 3600, "d": 86400}
+CGROUP_ROOT = "/sys/fs/cgroup"
+PROC_CGROUP = "/proc/self/cgroup"
+
+
+def parse_memory(value):
+    """Parse a memory amount such as `512M`, `60G` or `1.5T` into bytes.
+
+    Plain numbers are taken as megabytes, like build `size`."""
+    if isinstance(value, (int, float)):
+        return int(value * MEMORY_UNITS["M"])
+    match = re.match(r"^\s*(\d+(?:\.\d+)?)\s*([KMGT]?)i?B?\s*$", str(value), re.IGNORECASE)
+    if not match:
+        raise FormatError("Cannot parse memory amount '{}'".format(value))
+    return int(float(match.group(1)) * MEMORY_UNITS[match.group(2).upper()])
+
+
+def parse_duration(value):
+    """Parse a duration such as `90`, `30m`, `1.5h` or `2h30m` into seconds.
+
+    Plain numbers are taken as seconds."""
+    pattern = r"^\s*(\d+(\.\d+)?\s*[smhd]\s*)*(\d+(\.\d+)?\s*)?$"
+    if isinstance(value, bool) or not re.match(pattern, str(value), re.IGNORECASE):
+        raise FormatError("Cannot parse duration '{}'".format(value))
+    parts = re.findall(r"(\d+(?:\.\d+)?)\s*([smhd]?)", str(value).lower())
+    seconds = sum(float(number) * DURATION_UNITS[unit] for number, unit in parts)
+    if seconds <= 0:
+        raise FormatError("Duration '{}' must be positive".format(value))
+    return seconds
+
+
+def format_memory(amount):
+    """Format a byte count for humans, e.g. `1.5G`."""
+    for unit in ["T", "G", "M", "K"]:
+        if amount >= MEMORY_UNITS[unit]:
+            return "{:.3g}{}".format(float(amount) / MEMORY_UNITS[unit], unit)
+    return str(amount)
+
+
+def read_first_line(path):
+    """Return the stripped first line of a file, or None if unreadable."""
+    try:
+        with open(path) as f:
+            return f.readline().strip()
+    except (IOError, OSError):
+        return None
+
+
+def cgroup_directories(controller):
+    """Return the cgroup directories limiting this process for a controller, innermost first.
+
+    Limits may be set on the process's own cgroup (e.g. by SLURM or systemd)
+    or on any of its ancestors, so all of them are returned, down to the root.
+    Covers cgroup v2 (one hierarchy under CGROUP_ROOT) and v1 (one per controller)."""
+    try:
+        with open(PROC_CGROUP) as f:
+            entries = [line.rstrip("\n").split(":", 2) for line in f]
+    except (IOError, OSError):
+        entries = []
+
+    directories = []
+    for entry in entries + [["0", "", "/"], ["0", controller, "/"]]:  # Roots, if /proc is unreadable
+        if len(entry) != 3:
+            continue
+        controllers, path = entry[1], entry[2]
+        if not controllers:
+            mounts = [CGROUP_ROOT]
+        elif controller in controllers.split(","):
+            mounts = [os.path.join(CGROUP_ROOT, controllers), os.path.join(CGROUP_ROOT, controller)]
+        else:
+            continue
+        for mount in mounts:
+            current = path
+            while True:
+                directory = os.path.normpath(os.path.join(mount, current.lstrip("/")))
+                if directory not in directories:
+                    directories.append(directory)
+                if current in ["/", ""]:
+                    break
+                current = os.path.dirname(current)
+    return directories
+
+
+def detect_cpus():
+    """Number of CPUs available to this process, honoring affinity and cgroup CPU quotas."""
+    try:
+        cpus = len(os.sched_getaffinity(0))
+    except AttributeError:  # Python 2 or non-Linux
+        cpus = multiprocessing.cpu_count()
+
+    quotas = []
+    for directory in cgroup_directories("cpu"):
+        cpu_max = read_first_line(os.path.join(directory, "cpu.max"))  # cgroup v2: "<quota> <period>"
+        if cpu_max and not cpu_max.startswith("max"):
+            quota, period = cpu_max.split()
+            quotas.append(float(quota) / float(period))
+        v1_quota = read_first_line(os.path.join(directory, "cpu.cfs_quota_us"))
+        v1_period = read_first_line(os.path.join(directory, "cpu.cfs_period_us"))
+        if v1_quota and v1_period and int(v1_quota) > 0:
+            quotas.append(float(v1_quota) / float(v1_period))
+
+    if quotas:
+        cpus = min(cpus, max(1, int(min(quotas))))
+    return cpus
+
+
+def detect_memory():
+    """Bytes of memory available to this process, honoring cgroup limits; None if unknown."""
+    limits = []
+    for directory in cgroup_directories("memory"):
+        for name in ["memory.max", "memory.limit_in_bytes"]:  # cgroup v2, v1
+            value = read_first_line(os.path.join(directory, name))
+            if value and value.isdigit():
+                limits.append(int(value))
+
+    try:
+        with open("/proc/meminfo") as f:
+            for line in f:
+                if line.startswith("MemTotal:"):
+                    limits.append(int(line.split()[1]) * 1024)
+                    break
+    except (IOError, OSError):
+        pass
+
+    return min(limits) if limits else None
+
+
+class Budget():
+    """Resources that concurrently running steps may use together."""
+
+    def __init__(self, cpus=None, memory=None):
+        """Initialize a budget; unspecified values are detected from the host."""
+        self.cpus = cpus or detect_cpus()
+        self.memory = parse_memory(memory) if memory else detect_memory()
+
+    def __str__(self):
+        """Human-readable budget description."""
+        memory = format_memory(self.memory) if self.memory else "unknown"
+        return "{} CPUs, {} memory".format(self.cpus, memory)
+
+    def assign(self, step):
+        """Return (cpus, memory) assigned to a step, clamped to the budget."""
+        cpus = min(step.cpus, self.cpus)
+        memory = min(step.memory, self.memory) if self.memory else step.memory
+        return cpus, memory
+
+    def workers(self, step):
+        """Return how many items of a foreach step run concurrently: its `workers`, or as many as fit."""
+        return step.workers or max(1, self.cpus // self.assign(step)[0])
+
+    def reserve(self, step):
+        """Return (cpus, memory) a step occupies while running, clamped to the budget.
+
+        A foreach step occupies the resources of all its workers."""
+        cpus, memory = self.assign(step)
+        if step.foreach is None:
+            return cpus, memory
+        workers = self.workers(step)
+        memory *= workers
+        return min(cpus * workers, self.cpus), min(memory, self.memory) if self.memory else memory
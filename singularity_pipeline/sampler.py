@@ -0,0 +1,132 @@
+"""Live sampling of a running step's process tree through /proc."""
+
+import os
+import threading
+import time
+
+from .report import process_tree
+from .util import ensure_directory
+
+CLOCK_TICKS = os.sysconf("SC_CLK_TCK")
+
+
+def read_process(pid):
+    """Return (CPU ticks incl. waited-for children, RSS in kB, read bytes, write bytes) of one process.
+
+    Values that can't be read (e.g. /proc/<pid>/io of another user) are 0.
+    Returns None if the process is gone."""
+    try:
+        with open("/proc/{}/stat".format(pid)) as f:
+            fields = f.read().rsplit(")", 1)[1].split()
+        ticks = sum(int(value) for value in fields[11:15])  # utime, stime, cutime, cstime
+    except (IOError, OSError, IndexError, ValueError):
+        return None
+
+    rss = 0
+    try:
+        with open("/proc/{}/status".format(pid)) as f:
+            for line in f:
+                if line.startswith("VmRSS:"):
+                    rss = int(line.split()[1])
+                    break
+    except (IOError, OSError, ValueError):
+        pass
+
+    read_bytes = write_bytes = 0
+    try:
+        with open("/proc/{}/io".format(pid)) as f:
+            for line in f:
+                if line.startswith("read_bytes:"):
+                    read_bytes = int(line.split()[1])
+                elif line.startswith("write_bytes:"):
+                    write_bytes = int(line.split()[1])
+    except (IOError, OSError, ValueError):
+        pass
+
+    return ticks, rss, read_bytes, write_bytes
+
+
+class Sampler():
+    """Thread polling a process tree's CPU, memory and I/O at a fixed interval.
+
+    Samples are (seconds since start, CPU %, RSS kB, bytes read, bytes
+    written), where I/O counts are cumulative for the step. I/O of a
+    process is only counted while it is alive, so it is approximate for
+    steps made of many short-lived processes."""
+
+    def __init__(self, interval=1.0, path=None):
+        """Initialize a sampler.
+
+        interval - seconds between samples
+        path     - file to write the time series to as TSV, or None"""
+        self.interval = interval
+        self.path = path
+        self.samples = []
+        self.stopped = threading.Event()
+        self.thread = None
+        self.pid = None
+
+    def start(self, pid):
+        """Start sampling the tree rooted at pid."""
+        self.pid = pid
+        self.thread = threading.Thread(target=self.__run)
+        self.thread.daemon = True
+        self.thread.start()
+
+    def __run(self):
+        """Take samples until stopped."""
+        started = last_time = time.time()
+        last_ticks = 0
+        io_seen = {}  # pid -> last (read, write) bytes, to accumulate I/O of exited processes
+        io_total = [0, 0]
+        while True:
+            ticks = rss = 0
+            for pid in process_tree(self.pid):
+                values = read_process(pid)
+                if values is None:
+                    continue
+                ticks += values[0]
+                rss += values[1]
+                previous = io_seen.get(pid, (0, 0))
+                io_total[0] += max(0, values[2] - previous[0])
+                io_total[1] += max(0, values[3] - previous[1])
+                io_seen[pid] = values[2:]
+
+            now = time.time()
+            cpu = 0.0
+            if self.samples:  # The first sample only sets the baseline for CPU usage
+                cpu = 100.0 * max(0, ticks - last_ticks) / CLOCK_TICKS / max(now - last_time, 1e-6)
+            self.samples.append((round(now - started, 3), round(cpu, 1), rss, io_total[0], io_total[1]))
+            last_ticks, last_time = ticks, now
+
+            if self.stopped.wait(self.interval):
+                break
+
+    def stop(self):
+        """Stop sampling, write the time series if requested and return its summary."""
+        self.stopped.set()
+        if self.thread:
+            self.thread.join()
+        if self.path:
+            ensure_directory(os.path.dirname(self.path))
+            with open(self.path, "w") as f:
+                f.write("seconds\tcpu_percent\trss_kb\tread_bytes\twrite_bytes\n")
+                for sample in self.samples:
+                    f.write("\t".join(str(value) for value in sample) + "\n")
+        return self.summary()
+
+    def summary(self):
+        """Peak and average CPU % and RSS, and bytes read and written, as measurement fields."""
+        if not self.samples:
+            return {}
+        cpu = [sample[1] for sample in self.samples[1:]] or [0.0]  # The first sample has no CPU rate
+        rss = [sample[2] for sample in self.samples]
+        return {
+            "samples": len(self.samples),
+            "cpu_percent_peak": max(cpu),
+            "cpu_percent_avg": round(sum(cpu) / len(cpu), 1),
+            "rss_peak_kb": max(rss),
+            "rss_avg_kb": sum(rss) // len(rss),
+            "read_bytes": self.samples[-1][3],
+            "write_bytes": self.samples[-1][4]
+        }
@@ -0,0 +1,275 @@
+"""Long-lived pipeline daemon accepting run requests over a Unix socket.
+
+Protocol: a client connects and sends one JSON object on a single line:
+
+    {"pipeline": "pipeline.yaml", "command": "run", "substitutions": {"sample": "A"}}
+
+`pipeline` defaults to the description the server was started with,
+`command` is "run" (default) or "test". The server answers with JSON Lines:
+`queued`, `rejected` (queue full or bad request), `started`, `log` (messages
+and step output), the pipeline's events (`step.started`, `step.finished`,
+`step.skipped`, ...) and finally
+`finished` with `status` "ok" or "failed", then closes the connection.
+
+Each request runs on its own clone of the warm pipeline. With `--instance`,
+a warm pipeline keeps one instance running, stopped once the description
+is reloaded and no request uses it any more; pipelines with staged binds
+start an instance per request instead, so it sees the scratch copies.
+Requests using
+the run journal (`test`, and `run` without substitutions) run one at a
+time per description; runs with substitutions bypass it and run concurrently."""
+
+import json
+import os
+import socket
+import threading
+import time
+
+try:
+    import queue
+except ImportError:  # Python 2
+    import Queue as queue
+
+from .eprint import EPrint, Sink
+from .errors import LoadError
+
+
+class PipelineServer():
+    """Keeps parsed pipelines warm and runs requests on a bounded worker pool."""
+
+    def __init__(self, socket_path, load_pipeline, eprint, workers=1, queue_size=16, default_pipeline=None):
+        """Initialize a server.
+
+        socket_path      - Unix socket to listen on
+        load_pipeline    - callable(path, eprint) -> Pipeline, used on cache misses
+        eprint           - EPrint for server-level messages
+        workers          - maximum number of concurrently running requests
+        queue_size       - maximum number of requests waiting for a worker
+        default_pipeline - description used when a request names none"""
+        self.socket_path = socket_path
+        self.load_pipeline = load_pipeline
+        self.eprint = eprint
+        self.workers = workers
+        self.default_pipeline = default_pipeline
+        self.requests = queue.Queue(maxsize=queue_size)
+        self.pipelines = {}
+        self.journal_locks = {}  # Description path -> lock serializing requests that use the run journal
+        self.instances = {}  # Pipeline -> its running persistent instance
+        self.users = {}  # Pipeline -> number of requests running on it
+        self.retired = set()  # Replaced pipelines whose instance stops when their last request ends
+        self.lock = threading.Lock()
+        self.running = False
+
+    def serve(self):
+        """Accept connections until interrupted; then stop warm instances and remove the socket."""
+        if os.path.exists(self.socket_path):
+            os.remove(self.socket_path)
+        listener = socket.socket(socket.AF_UNIX, socket.SOCK_STREAM)
+        listener.bind(self.socket_path)
+        listener.listen(64)
+        listener.settimeout(0.5)  # Stay responsive to KeyboardInterrupt
+        self.running = True
+
+        for _ in range(self.workers):
+            thread = threading.Thread(target=self.__worker)
+            thread.daemon = True
+            thread.start()
+
+        if self.default_pipeline:
+            self.pipeline(self.default_pipeline)
+
+        self.eprint.bold("# Serving on {} with {} workers.\n".format(self.socket_path, self.workers))
+        try:
+            while self.running:
+                try:
+                    connection, _ = listener.accept()
+                except socket.timeout:
+                    continue
+                thread = threading.Thread(target=self.__accept, args=(connection,))
+                thread.daemon = True
+                thread.start()
+        finally:
+            self.running = False
+            listener.close()
+            os.remove(self.socket_path)
+            with self.lock:
+                for pipeline in list(self.instances):
+                    self.__stop_instance(pipeline)
+            self.eprint.bold("# Server stopped.\n")
+
+    def pipeline(self, path):
+        """Return the warm Pipeline for a description path, (re)loading it if changed on disk."""
+        with self.lock:
+            return self.__load(path)
+
+    def acquire(self, path):
+        """Return the warm Pipeline for a description path, counted as in use until release()."""
+        with self.lock:
+            pipeline = self.__load(path)
+            self.users[pipeline] = self.users.get(pipeline, 0) + 1
+            return pipeline
+
+    def release(self, pipeline):
+        """Stop counting a request on a pipeline; stops the instance of a replaced pipeline once unused."""
+        with self.lock:
+            self.users[pipeline] -= 1
+            if not self.users[pipeline]:
+                del self.users[pipeline]
+                if pipeline in self.retired:
+                    self.retired.discard(pipeline)
+                    self.__stop_instance(pipeline)
+
+    def __load(self, path):
+        """Return the cached pipeline for a path, or load it. Called with self.lock held."""
+        key = os.path.realpath(path)
+        mtime = os.path.getmtime(key)
+        cached = self.pipelines.get(key)
+        if cached and cached[0] == mtime:
+            return cached[1]
+        pipeline = self.load_pipeline(path, self.eprint)
+        if pipeline.use_instance and not pipeline.dry_run:
+            if pipeline.bind_stages:
+                self.eprint.yellow("{}: staged binds need a fresh instance per request; none is kept warm.".format(
+                    path
+                ))
+            else:
+                instance = pipeline.persistent_instance()
+                instance.__enter__()  # Kept warm until replaced or the server stops
+                self.instances[pipeline] = instance
+        if cached:
+            if self.users.get(cached[1]):
+                self.retired.add(cached[1])
+            else:
+                self.__stop_instance(cached[1])
+        self.pipelines[key] = (mtime, pipeline)
+        return pipeline
+
+    def __stop_instance(self, pipeline):
+        """Stop the warm instance of a pipeline, if any. Called with self.lock held."""
+        instance = self.instances.pop(pipeline, None)
+        if instance is not None:
+            instance.__exit__(None, None, None)
+
+    def __accept(self, connection):
+        """Read one request from a connection and queue it."""
+        client = Client(connection)
+        try:
+            request = json.loads(client.stream.readline().decode("utf-8"))
+            if not isinstance(request, dict):
+                raise ValueError("request must be a JSON object")
+            if request.get("command", "run") not in ["run", "test"]:
+                raise ValueError("unknown command '{}'".format(request.get("command")))
+            if not isinstance(request.get("substitutions", {}), dict):
+                raise ValueError("substitutions must be a JSON object")
+        except ValueError as e:
+            client.send("rejected", reason="Bad request: {}".format(e))
+            client.close()
+            return
+
+        with client.lock:  # Make sure "queued" precedes the worker's "started"
+            try:
+                self.requests.put_nowait((request, client))
+            except queue.Full:
+                client.send("rejected", reason="Queue full", locked=True)
+                client.close()
+                return
+            client.send("queued", position=self.requests.qsize(), locked=True)
+
+    def __worker(self):
+        """Process queued requests until the server stops."""
+        while True:
+            request, client = self.requests.get()
+            try:
+                self.__handle(request, client)
+            finally:
+                client.close()
+
+    def __handle(self, request, client):
+        """Run one request, streaming its events to the client."""
+        client.send("started")
+        started = time.time()
+        try:
+            path = request.get("pipeline") or self.default_pipeline
+            if not path:
+                raise RuntimeError("No pipeline specified")
+            try:
+                warm = self.acquire(path)
+            except (IOError, OSError, LoadError):
+                raise RuntimeError("Cannot load pipeline description {}".format(path))
+            pipeline = warm.clone(EPrint(sinks=[ClientSink(client)], quiet=True))
+
+            lock = None
+            if request.get("command", "run") == "test" or not request.get("substitutions"):
+                with self.lock:
+                    lock = self.journal_locks.setdefault(os.path.realpath(path), threading.Lock())
+                lock.acquire()
+            try:
+                if request.get("command", "run") == "test":
+                    pipeline.test()
+                else:
+                    pipeline.run(overrides=request.get("substitutions"))
+            finally:
+                if lock:
+                    lock.release()
+                self.release(warm)
+        except Exception as e:
+            client.send("finished", status="failed", error=str(e), wall_time=round(time.time() - started, 4))
+        else:
+            client.send("finished", status="ok", wall_time=round(time.time() - started, 4))
+
+
+class Client():
+    """A connected client receiving JSON Lines events, safe to use from several threads."""
+
+    def __init__(self, connection):
+        """Wrap an accepted socket."""
+        self.connection = connection
+        self.stream = connection.makefile("rwb")
+        self.lock = threading.Lock()
+
+    def send(self, event, locked=False, **fields):
+        """Send one event. Pass locked=True if already holding self.lock."""
+        fields["event"] = event
+        fields.setdefault("time", time.time())
+        line = (json.dumps(fields, sort_keys=True) + "\n").encode("utf-8")
+        if locked:
+            self.__write(line)
+        else:
+            with self.lock:
+                self.__write(line)
+
+    def __write(self, line):
+        """Write a line to the client; a disconnected client is ignored."""
+        try:
+            self.stream.write(line)
+            self.stream.flush()
+        except (IOError, OSError, ValueError):
+            pass
+
+    def close(self):
+        """Close the connection."""
+        try:
+            self.stream.close()
+            self.connection.close()
+        except (IOError, OSError):
+            pass
+
+
+class ClientSink(Sink):
+    """EPrint sink forwarding messages, step output and events to a client."""
+
+    def __init__(self, client):
+        """Initialize a sink for a Client."""
+        self.client = client
+
+    def message(self, style, args, kwargs):
+        """Send a message as a `log` event."""
+        self.client.send("log", text=" ".join(str(arg) for arg in args))
+
+    def output(self, prefix, text):
+        """Send a line of step output as a `log` event."""
+        self.client.send("log", text=prefix + " " + text)
+
+    def event(self, name, fields):
+        """Send an event as is."""
+        self.client.send(name, **fields)
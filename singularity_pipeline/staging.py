@@ -0,0 +1,57 @@
+"""Copying bind sources to node-local scratch and back."""
+
+import os
+import shutil
+
+from .util import map_concurrently, ensure_directory
+
+STAGE_MODES = ["in", "out", "inout"]
+
+
+def copy_tree(source, target, workers=8, only_changed=False):
+    """Copy a file or directory tree, copying files on a thread pool.
+
+    only_changed - skip files whose size and mtime already match the target.
+    Returns (number of files copied, number of bytes copied)."""
+    if os.path.isfile(source):
+        pairs = [(source, target)]
+    else:
+        pairs = []
+        for root, dirs, files in os.walk(source):
+            relative = os.path.relpath(root, source)
+            target_root = os.path.normpath(os.path.join(target, relative))
+            ensure_directory(target_root)
+            pairs.extend((os.path.join(root, name), os.path.join(target_root, name)) for name in files)
+
+    def copy(pair):
+        source_file, target_file = pair
+        stat = os.stat(source_file)
+        if only_changed and os.path.exists(target_file):
+            target_stat = os.stat(target_file)
+            if target_stat.st_size == stat.st_size and target_stat.st_mtime == stat.st_mtime:
+                return 0
+        shutil.copy2(source_file, target_file)
+        return stat.st_size
+
+    sizes = map_concurrently(copy, pairs, workers=workers)
+    return len([size for size in sizes if size]), sum(sizes)
+
+
+def stage_in(source, scratch, mode, workers=8):
+    """Prepare the scratch copy of a bind source. Returns (files, bytes) copied."""
+    if mode == "out":
+        if not os.path.isdir(scratch):
+            os.makedirs(scratch)
+        return 0, 0
+    return copy_tree(source, scratch, workers)
+
+
+def stage_out(scratch, source, mode, workers=8):
+    """Sync new and changed files from scratch back to the bind source.
+
+    Deletions in scratch are not propagated. Returns (files, bytes) copied."""
+    if mode == "in":
+        return 0, 0
+    if os.path.isdir(scratch) and not os.path.isdir(source):
+        os.makedirs(source)
+    return copy_tree(scratch, source, workers, only_changed=True)
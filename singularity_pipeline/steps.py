@@ -0,0 +1,243 @@
+"""Step parsing and dependency-aware scheduling for command batches."""
+
+import threading
+
+from .errors import FormatError
+from .resources import parse_memory, parse_duration
+
+try:
+    string_types = basestring  # Python 2
+except NameError:
+    string_types = str
+
+
+class Step():
+    """A single shell command in a batch, with its dependencies."""
+
+    def __init__(self, index, command, name=None, depends_on=None, spec=None):
+        """Initialize a step.
+
+        index      - position of the step in its batch (0-based)
+        command    - shell command template, formatted before execution
+        name       - optional user-supplied step name
+        depends_on - list of step indices that must finish first
+        spec       - raw step description (dict) for optional step attributes
+        """
+        self.index = index
+        self.command = command
+        self.name = name
+        self.depends_on = depends_on or []
+        self.spec = spec or {}
+        self.cpus = 1
+        self.memory = 0
+        self.timeout = None  # Seconds
+        self.timed_out = False
+        self.output_tail = None  # Last output lines, set when the step fails with captured output
+        self.foreach = None  # Glob or list of paths the command is applied to, item by item
+        self.gather = None  # Command run once all items succeeded
+        self.batch = 1  # Items handed to a worker at a time
+        self.workers = None  # Items run concurrently (default: as many as fit in the CPU budget)
+        self.failed_items = []  # (item, exit code) of failed items, set when a foreach step fails
+
+    @property
+    def key(self):
+        """Stable identifier of the step: its name, or its 1-based number."""
+        return self.name or str(self.index + 1)
+
+    def __str__(self):
+        """Human-readable step label, e.g. `3` or `3 (align_chr1)`."""
+        if self.name:
+            return "{} ({})".format(self.index + 1, self.name)
+        return str(self.index + 1)
+
+
+def parse_steps(commands):
+    """Parse a list of commands into a list of Steps.
+
+    Each entry is either a plain string or a dict with keys
+    `command` (required), `name`, `depends_on` (a name or list of names)
+    and optionally `inputs`/`outputs` (lists of paths),
+    `cpus`/`memory` resource hints and a `timeout`.
+    A `foreach` step applies its command to every path matching a glob (or
+    in a list), with `{item}`/`{item_stem}` substitutions, on a pool of
+    `workers` taking `batch` items at a time, then runs its `gather` command.
+    A step without `depends_on` depends on the step before it,
+    so plain command lists keep their sequential meaning."""
+    if not isinstance(commands, list):
+        raise FormatError("Run commands must be a list")
+
+    steps = []
+    names = {}
+    for index, entry in enumerate(commands):
+        if isinstance(entry, dict):
+            if not entry.get("command"):
+                raise FormatError("Step {} has no 'command'".format(index + 1))
+            name = entry.get("name")
+            if name is not None:
+                name = str(name)
+                if name in names:
+                    raise FormatError("Duplicate step name '{}'".format(name))
+                names[name] = index
+            for attribute in ["inputs", "outputs"]:
+                if not isinstance(entry.get(attribute, []), list):
+                    raise FormatError("Step {} '{}' must be a list".format(index + 1, attribute))
+            step = Step(index, entry.get("command"), name=name, spec=entry)
+            if "cpus" in entry:
+                if not isinstance(entry["cpus"], int) or entry["cpus"] < 1:
+                    raise FormatError("Step {} 'cpus' must be a positive integer".format(step))
+                step.cpus = entry["cpus"]
+            if "memory" in entry:
+                step.memory = parse_memory(entry["memory"])
+            if "timeout" in entry:
+                step.timeout = parse_duration(entry["timeout"])
+            if "foreach" in entry:
+                parse_foreach(step, entry)
+            elif "gather" in entry:
+                raise FormatError("Step {} has a 'gather' command but no 'foreach'".format(step))
+            steps.append(step)
+        elif isinstance(entry, string_types):
+            steps.append(Step(index, entry))
+        else:
+            raise FormatError("Step {} must be a string or a mapping".format(index + 1))
+
+    for step in steps:
+        if "depends_on" not in step.spec:
+            step.depends_on = [step.index - 1] if step.index else []
+            continue
+        deps = step.spec.get("depends_on") or []
+        if not isinstance(deps, list):
+            deps = [deps]
+        for dep in deps:
+            if str(dep) not in names:
+                raise FormatError("Step {} depends on unknown step '{}'".format(step, dep))
+            step.depends_on.append(names[str(dep)])
+
+    topological_order(steps)  # Raises on cycles
+    return steps
+
+
+def parse_foreach(step, entry):
+    """Set the foreach attributes of a step from its description."""
+    foreach = entry["foreach"]
+    if isinstance(foreach, list):
+        if not all(isinstance(item, string_types) for item in foreach):
+            raise FormatError("Step {} 'foreach' list must contain paths".format(step))
+    elif not isinstance(foreach, string_types) or not foreach:
+        raise FormatError("Step {} 'foreach' must be a glob or a list of paths".format(step))
+    step.foreach = foreach
+    step.gather = entry.get("gather")
+    if step.gather is not None and not isinstance(step.gather, string_types):
+        raise FormatError("Step {} 'gather' must be a command".format(step))
+    for attribute in ["batch", "workers"]:
+        if attribute in entry:
+            if not isinstance(entry[attribute], int) or isinstance(entry[attribute], bool) or entry[attribute] < 1:
+                raise FormatError("Step {} '{}' must be a positive integer".format(step, attribute))
+            setattr(step, attribute, entry[attribute])
+
+
+def topological_order(steps):
+    """Return steps in a dependency-respecting order, stable w.r.t. declaration order.
+
+    Steps are taken in waves: all steps whose dependencies are met, in declaration order."""
+    position = dict((step.index, number) for number, step in enumerate(steps))
+    waiting = {}  # Step index -> number of unfinished dependencies
+    dependents = {}
+    for step in steps:
+        deps = set(step.depends_on)
+        waiting[step.index] = len(deps)
+        for dep in deps:
+            dependents.setdefault(dep, []).append(step)
+
+    order = []
+    ready = [step for step in steps if not waiting[step.index]]
+    while ready:
+        order.extend(ready)
+        unblocked = []
+        for step in ready:
+            for dependent in dependents.get(step.index, []):
+                waiting[dependent.index] -= 1
+                if not waiting[dependent.index]:
+                    unblocked.append(dependent)
+        ready = sorted(unblocked, key=lambda step: position[step.index])
+
+    if len(order) < len(steps):
+        done = set(step.index for step in order)
+        raise FormatError("Circular dependency between steps {}".format(
+            ", ".join(str(step) for step in steps if step.index not in done)
+        ))
+    return order
+
+
+def run_steps(steps, launch, jobs=1, budget=None):
+    """Run steps with launch(step) -> exit code, respecting dependencies.
+
+    Up to `jobs` steps run concurrently (0 for no limit). With a Budget,
+    a step only starts if its cpus/memory (times its workers, for foreach
+    steps) fit next to the running ones; a step exceeding the whole budget
+    runs alone. After the first failure
+    no new steps are started; already running ones are waited for.
+
+    Returns (exit code, failed Step), or (0, None) if all steps succeeded."""
+    if jobs == 1:
+        for step in topological_order(steps):
+            ret_code = launch(step)
+            if ret_code:
+                return ret_code, step
+        return 0, None
+
+    condition = threading.Condition()
+    pending = topological_order(steps)
+    running = {}
+    finished = []
+    done = set()
+    failure = None
+    errors = []
+
+    def fits(step):
+        if not running or budget is None:
+            return True
+        cpus, memory = budget.reserve(step)
+        used_cpus = sum(used[0] for used in running.values())
+        used_memory = sum(used[1] for used in running.values())
+        return (
+            used_cpus + cpus <= budget.cpus and
+            (not budget.memory or used_memory + memory <= budget.memory)
+        )
+
+    def worker(step):
+        try:
+            ret_code = launch(step)
+        except BaseException as e:  # Re-raised in the calling thread
+            errors.append(e)
+            ret_code = -1
+        with condition:
+            finished.append((step, ret_code))
+            condition.notify()
+
+    with condition:
+        while True:
+            if failure is None and not errors:
+                for step in list(pending):
+                    if jobs and len(running) >= jobs:
+                        break
+                    if all(dep in done for dep in step.depends_on) and fits(step):
+                        pending.remove(step)
+                        running[step.index] = budget.reserve(step) if budget else (0, 0)
+                        thread = threading.Thread(target=worker, args=(step,))
+                        thread.daemon = True
+                        thread.start()
+            if not running:
+                break
+            condition.wait()
+            while finished:
+                step, ret_code = finished.pop(0)
+                running.pop(step.index)
+                if ret_code:
+                    if failure is None:
+                        failure = (ret_code, step)
+                else:
+                    done.add(step.index)
+
+    if errors:
+        raise errors[0]
+    return failure or (0, None)
@@ -0,0 +1,136 @@
+"""Shared image store deduplicating builds across pipelines and users."""
+
+import contextlib
+import errno
+import fcntl
+import json
+import os
+import shutil
+import time
+
+from .fingerprint import data_digest
+from .util import ensure_directory
+
+
+class ImageStore():
+    """Directory of built images keyed by build source and fingerprint.
+
+    Each entry consists of `<key>.img`, `<key>.json` (metadata; its mtime
+    marks the last use) and `<key>.lock`. Builders of the same key serialize
+    on the entry lock, so only one of them builds while the others wait and
+    then link the finished image."""
+
+    def __init__(self, path, max_size=None):
+        """Open (creating if needed) a store at path, optionally capped at max_size bytes."""
+        self.path = path
+        self.max_size = max_size
+        ensure_directory(path)
+
+    @staticmethod
+    def key(source, fingerprint):
+        """Store key for a build source and fingerprint."""
+        return data_digest({"source": source, "fingerprint": fingerprint})[:32]
+
+    def image_path(self, key):
+        """Path of the stored image for a key."""
+        return os.path.join(self.path, key + ".img")
+
+    @contextlib.contextmanager
+    def locked(self, key, blocking=True):
+        """Hold the lock of an entry; yields False if non-blocking and already locked."""
+        with open(os.path.join(self.path, key + ".lock"), "a") as lock:
+            try:
+                fcntl.flock(lock.fileno(), fcntl.LOCK_EX | (0 if blocking else fcntl.LOCK_NB))
+            except (IOError, OSError) as e:
+                if blocking or e.errno not in [errno.EAGAIN, errno.EACCES]:
+                    raise
+                yield False
+                return
+            yield True
+
+    def has(self, key):
+        """Check whether a complete entry exists for key."""
+        return os.path.isfile(self.image_path(key)) and os.path.isfile(os.path.join(self.path, key + ".json"))
+
+    def fetch(self, key, target):
+        """Link the stored image to target (hardlink, or symlink across filesystems) and mark it used."""
+        if os.path.lexists(target):
+            os.remove(target)
+        try:
+            os.link(self.image_path(key), target)
+        except OSError:
+            os.symlink(os.path.abspath(self.image_path(key)), target)
+        os.utime(os.path.join(self.path, key + ".json"), None)
+
+    def add(self, key, image, **metadata):
+        """Add a built image to the store, linking it if possible and copying otherwise."""
+        temp_path = self.image_path(key) + ".tmp"
+        if os.path.exists(temp_path):
+            os.remove(temp_path)
+        try:
+            os.link(image, temp_path)
+        except OSError:
+            shutil.copy2(image, temp_path)
+        os.rename(temp_path, self.image_path(key))
+
+        metadata.update({"created": time.time(), "size": os.path.getsize(self.image_path(key))})
+        with open(os.path.join(self.path, key + ".json"), "w") as f:
+            json.dump(metadata, f, indent=1, sort_keys=True)
+
+    def entries(self):
+        """List entries as dicts (key, size, last_used and stored metadata), most recently used first."""
+        entries = []
+        for name in os.listdir(self.path):
+            if not name.endswith(".json"):
+                continue
+            key = name[:-len(".json")]
+            meta_path = os.path.join(self.path, name)
+            try:
+                with open(meta_path) as f:
+                    entry = json.load(f)
+                entry["last_used"] = os.path.getmtime(meta_path)
+                entry["size"] = os.path.getsize(self.image_path(key))
+            except (IOError, OSError, ValueError):
+                continue
+            entry["key"] = key
+            entries.append(entry)
+        return sorted(entries, key=lambda entry: entry["last_used"], reverse=True)
+
+    def gc(self, max_size=None):
+        """Remove incomplete entries, then evict least recently used ones above max_size.
+
+        Entries currently locked (being built or fetched) are never removed.
+        Returns a list of removed keys."""
+        if max_size is None:
+            max_size = self.max_size
+        removed = []
+
+        complete = set(entry["key"] for entry in self.entries())
+        for name in os.listdir(self.path):
+            key = name.split(".")[0]
+            if key in complete or not name.endswith((".img", ".tmp", ".json")):
+                continue
+            with self.locked(key, blocking=False) as acquired:
+                if acquired:
+                    self.__remove(key)
+                    removed.append(key)
+
+        if max_size is not None:
+            total = 0
+            for entry in self.entries():
+                total += entry["size"]
+                if total <= max_size:
+                    continue
+                with self.locked(entry["key"], blocking=False) as acquired:
+                    if acquired:
+                        self.__remove(entry["key"])
+                        removed.append(entry["key"])
+                        total -= entry["size"]
+        return removed
+
+    def __remove(self, key):
+        """Delete all files of an entry, except its lock."""
+        for suffix in [".json", ".img", ".img.tmp"]:
+            path = os.path.join(self.path, key + suffix)
+            if os.path.exists(path):
+                os.remove(path)
@@ -0,0 +1,47 @@
+"""Parameter sweeps: substitution matrices and row labels."""
+
+import csv
+import itertools
+
+import yaml
+
+from .errors import FormatError
+
+
+def load_matrix(source, path=""):
+    """Load a sweep matrix as a list of substitution dicts.
+
+    source - open file handle
+    path   - file name, used to pick the format by extension
+
+    CSV/TSV files give one row per line, with substitution names in the header.
+    YAML files hold either a list of mappings (one per row) or a mapping
+    of lists, expanded into their Cartesian product."""
+    if path.endswith(".csv") or path.endswith(".tsv"):
+        delimiter = "\t" if path.endswith(".tsv") else ","
+        rows = [dict(row) for row in csv.DictReader(source, delimiter=delimiter)]
+    else:
+        try:
+            data = yaml.safe_load(source)
+        except yaml.YAMLError as e:
+            raise FormatError("Error parsing sweep matrix: {}".format(e))
+        if isinstance(data, dict):
+            names = sorted(data)
+            values = [data[name] if isinstance(data[name], list) else [data[name]] for name in names]
+            rows = [dict(zip(names, combination)) for combination in itertools.product(*values)]
+        elif isinstance(data, list) and all(isinstance(row, dict) for row in data):
+            rows = data
+        else:
+            raise FormatError("Sweep matrix must be a list of mappings or a mapping of lists")
+
+    if not rows:
+        raise FormatError("Sweep matrix is empty")
+    return rows
+
+
+def row_label(index, row, width=60):
+    """Short human-readable label for a matrix row."""
+    values = ", ".join("{}={}".format(key, row[key]) for key in sorted(row))
+    if len(values) > width:
+        values = values[:width - 3] + "..."
+    return "row {} ({})".format(index + 1, values)
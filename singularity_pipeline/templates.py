@@ -16,8 +16,13 @@ substitutions:
   text: "Moo"
 
 ## Bind specifications (souce:destination) to be passed to Singularity
+## A bind may also be a mapping; `stage` (in, out or inout) copies it through
+## node-local scratch ($TMPDIR or --scratch) around the run stage
 binds:
   - "/var/tmp:/var/tmp"
+  # - source: /shared/project/data
+  #   dest: /data
+  #   stage: in
 
 ## Build instructions
 build:
@@ -40,6 +45,19 @@ build:
   # commands:
   # - "singularity ..."
 
+  ## Optional: convert the built image to a compressed read-only one
+  ## (squashfs with Singularity 2.x, SIF with 3.x), smoke-test it with exec and
+  ## compare size and exec latency; replace: true makes it the pipeline image.
+  ## compression/level need Singularity 3.x (mksquashfs -comp gzip, lz4, xz, zstd)
+  # convert:
+  #   compression: zstd
+  #   level: 19
+  #   smoke: "true"
+  #   replace: false
+
+  ## Optional: time limit for all build commands together (e.g. 90, 30m, 2h)
+  # timeout: 1h
+
   ## Credentials for docker regsiteries
   ## Passed to singularity as environment variables
   # credentials:
@@ -56,8 +74,41 @@ run:
   ## * {binds} for "[-B <bind specification>]"
   ## * {image} for container file name
   ##  will be substituted; for literal {} (e.g. shell) use {{}}
+  ## With --instance, {exec} and {run} target one persistent instance instead
+  ## Steps may also be mappings with a name and dependencies;
+  ## a step without depends_on runs after the previous one.
+  ## Independent steps run concurrently with --jobs N.
+  # - name: chr1
+  #   command: "{exec} ..."
+  #   depends_on: [prepare]
+  ##  Optional: skip the step on re-runs while outputs are up to date
+  ##  (see --check-mode and --rebuild-step)
+  #   inputs: [data/chr1.fa]
+  #   outputs: [out/chr1.bam]
+  ##  Optional resource hints used to pack concurrent steps (see --cpus/--memory);
+  ##  {threads} is substituted with the CPUs assigned to the step
+  #   cpus: 4
+  #   memory: 16G
+  ##  Optional: terminate the step if it runs longer (e.g. 90, 30m, 2h)
+  #   timeout: 2h
+  ## A foreach step runs its command once per file matching a glob (or per
+  ## path in a list), with {item} and {item_stem} (file name without
+  ## directory and extension); all items run even if some fail. Items with
+  ## up-to-date outputs are skipped; gather runs once all items succeeded,
+  ## with {items} the list of items.
+  # - name: align
+  #   foreach: "data/*.fastq"
+  #   command: "{exec} bwa mem ref.fa {item} > out/{item_stem}.sam"
+  #   outputs: ["out/{item_stem}.sam"]
+  ##  Optional: items run concurrently (default: as many as fit in --cpus)
+  ##  and items handed to a worker at a time (default: 1)
+  #   workers: 8
+  #   batch: 4
+  #   gather: "{exec} merge-sams out/all.sam out/*.sam"
   commands:
     - "{exec} /usr/games/cowsay {text} > cowsay.txt 2> /dev/null"
+  ## Optional: time limit for all run steps together; timed out steps report exit code 124
+  # timeout: 12h
 
 ## Test instructions
 test:
@@ -67,9 +118,16 @@ test:
   ## An array of scripts to be executed in shell to prepare test_files
   prepare_commands:
     - "echo '548c5e52a6c1abc728a6b8e27f5abdd4  cowsay.txt' > cowsay.md5"
+  ## Optional: checksums verified in-process after running, either inline
+  ## (path: hex digest; md5/sha1/sha256/sha512 inferred from length)
+  ## or the name of a md5sum/sha256sum-style file. Regenerate with --update-checksums.
+  # checksums:
+  #   cowsay.txt: 548c5e52a6c1abc728a6b8e27f5abdd4
   ## An array of scripts to be executed in shell after running
   validate_commands:
-    - "md5sum -c cowsay.md5"'''
+    - "md5sum -c cowsay.md5"
+  ## Optional: time limit for the prepare and for the validation commands
+  # timeout: 30m'''
 
 template_version = r'''
 %(prog)s version {version}
@@ -0,0 +1,49 @@
+"""Helpers shared across modules: creating directories and a bounded worker pool."""
+
+import os
+import threading
+
+
+def ensure_directory(path):
+    """Create a directory and its parents unless it exists, tolerating concurrent creation."""
+    if path and not os.path.isdir(path):
+        try:
+            os.makedirs(path)
+        except OSError:
+            if not os.path.isdir(path):  # Not created concurrently
+                raise
+
+
+def map_concurrently(func, items, workers=1):
+    """Call func(item) for every item on up to `workers` threads.
+
+    Unlike the step scheduler, keeps going after failures.
+    Returns results in item order; an exception in any call is re-raised at the end."""
+    items = list(items)
+    results = [None] * len(items)
+    errors = []
+    counter = iter(range(len(items)))
+    lock = threading.Lock()
+
+    def worker():
+        while not errors:
+            with lock:
+                index = next(counter, None)
+            if index is None:
+                return
+            try:
+                results[index] = func(items[index])
+            except BaseException as e:  # Re-raised in the calling thread
+                errors.append(e)
+
+    threads = [threading.Thread(target=worker) for _ in range(max(1, min(workers, len(items))))]
+    for thread in threads:
+        thread.daemon = True
+        thread.start()
+    for thread in threads:
+        while thread.is_alive():
+            thread.join(0.5)  # Keep the main thread responsive to KeyboardInterrupt
+
+    if errors:
+        raise errors[0]
+    return results
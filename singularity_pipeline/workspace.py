@@ -0,0 +1,156 @@
+"""Workspaces: several pipeline descriptions built and tested together."""
+
+import glob
+import os
+import re
+import sys
+import threading
+import time
+import yaml
+
+from .eprint import EPrint, ConsoleSink
+from .errors import LoadError, FormatError
+from .steps import string_types
+from .util import map_concurrently
+
+
+def find_descriptions(patterns, workspace=None):
+    """Expand description paths and globs, plus those listed in a workspace file.
+
+    A workspace file is YAML: a list of paths/globs, or a mapping with such a
+    list under `pipelines`; relative entries are relative to the file.
+    Returns unique paths in the given order, glob matches sorted."""
+    patterns = list(patterns)
+    if workspace:
+        with open(workspace) as f:
+            try:
+                entries = yaml.safe_load(f)
+            except yaml.YAMLError as e:
+                raise FormatError("Cannot parse workspace file {}: {}".format(workspace, e))
+        if isinstance(entries, dict):
+            entries = entries.get("pipelines")
+        if not isinstance(entries, list) or not all(isinstance(entry, string_types) for entry in entries):
+            raise FormatError("Workspace file {} must list pipeline descriptions".format(workspace))
+        patterns += [os.path.join(os.path.dirname(workspace), entry) for entry in entries]
+
+    paths = []
+    for pattern in patterns:
+        if re.search(r"[*?[]", pattern):
+            matches = sorted(glob.glob(pattern))
+            if not matches:
+                raise FormatError("No pipeline descriptions match '{}'".format(pattern))
+        else:
+            matches = [pattern]
+        paths.extend(path for path in matches if path not in paths)
+    return paths
+
+
+def collector(lines):
+    """Return a print()-like function appending its output to lines."""
+    def collect(*args, **kwargs):
+        lines.append(" ".join(str(arg) for arg in args) + kwargs.get("end", "\n"))
+    return collect
+
+
+class Workspace():
+    """Pipelines loaded once and processed concurrently, with output grouped per pipeline."""
+
+    def __init__(self, paths, load_pipeline, eprint, workers=1):
+        """Initialize a workspace.
+
+        paths         - pipeline description files
+        load_pipeline - callable(path, eprint) -> Pipeline, raising LoadError
+        eprint        - EPrint for workspace-level messages; its non-console sinks
+                        also receive the pipelines' events
+        workers       - maximum number of pipelines processed concurrently"""
+        self.paths = paths
+        self.load_pipeline = load_pipeline
+        self.eprint = eprint
+        self.workers = workers
+        self.lock = threading.Lock()
+
+    def run(self, command, action):
+        """Load all pipelines, then call action(pipeline) for each on up to `workers` threads.
+
+        Returns a list of result dicts (path, name, load and command status,
+        error, wall_time) in path order, after printing a summary matrix."""
+        quiet = not any(isinstance(sink, ConsoleSink) for sink in self.eprint.sinks)
+        sinks = [sink for sink in self.eprint.sinks if not isinstance(sink, ConsoleSink)]
+        self.eprint.bold("# Workspace of {} pipelines, {} at a time.\n".format(len(self.paths), self.workers))
+
+        entries = []
+        images = {}
+        for path in self.paths:
+            lines = []
+            eprint = EPrint(print_func=collector(lines) if self.workers != 1 else None, sinks=sinks, quiet=quiet,
+                            context={"description": path})
+            result = {"path": path, "name": None, "load": "failed", command: None, "error": None, "wall_time": 0}
+            pipeline = None
+            try:
+                pipeline = self.load_pipeline(path, eprint)
+                result["name"] = pipeline.description.get("name")
+                result["load"] = "ok"
+                if pipeline.imagefile in images:
+                    eprint.red("Image file {} is also used by {}".format(
+                        pipeline.imagefile, images[pipeline.imagefile]
+                    ))
+                    result["load"], pipeline = "failed", None
+                else:
+                    images[pipeline.imagefile] = path
+            except LoadError:
+                pass
+            entries.append((pipeline, eprint, lines, result))
+
+        def process(entry):
+            pipeline, eprint, lines, result = entry
+            started = time.time()
+            if pipeline is not None:
+                eprint.event("pipeline.started", command=command, pipeline=result["name"], image=pipeline.imagefile)
+                try:
+                    action(pipeline)
+                    result[command] = "ok"
+                except RuntimeError as e:
+                    result[command], result["error"] = "failed", str(e)
+                    eprint.red("ERROR: {}".format(e))
+                result["wall_time"] = round(time.time() - started, 4)
+                eprint.event("pipeline.finished", command=command, status=result[command], error=result["error"],
+                             wall_time=result["wall_time"])
+            if lines:
+                with self.lock:
+                    self.eprint.bold("## {}\n".format(
+                        result["path"] if not result["name"] else "{} ({})".format(result["name"], result["path"])
+                    ))
+                    sys.stderr.write("".join(lines) + "\n")
+                    sys.stderr.flush()
+            return result
+
+        try:
+            results = map_concurrently(process, entries, workers=self.workers)
+        except BaseException:
+            for pipeline, _, _, _ in entries:
+                if pipeline is not None:
+                    pipeline.cancel()
+            raise
+
+        self.summary(command, results)
+        return results
+
+    def summary(self, command, results):
+        """Print a matrix of load and command status per pipeline."""
+        self.eprint.bold("# Workspace summary:\n")
+        header = "{:<40} {:<8} {:<16} {:>10}".format("pipeline", "load", command, "wall time")
+        self.eprint.bold(header)
+        for result in results:
+            label = result["path"] if not result["name"] else "{} ({})".format(result["name"], result["path"])
+            line = "{:<40} {:<8} {:<16} {:>9.1f}s".format(
+                label, result["load"], result[command] or "-", result["wall_time"]
+            )
+            if result["load"] != "ok" or result[command] != "ok":
+                self.eprint.red(line)
+            else:
+                self.eprint.normal(line)
+        failed = len([result for result in results if result[command] != "ok"])
+        if failed:
+            self.eprint.yellow("\n{} of {} pipelines failed.".format(failed, len(results)))
+        else:
+            self.eprint.bold("\nAll {} pipelines succeeded.".format(len(results)))
@@ -0,0 +1,137 @@
+"""Batch executor tests against fake `sbatch`, `squeue` and `scancel` commands."""
+
+import os
+import shutil
+import signal
+import tempfile
+import threading
+import unittest
+
+from singularity_pipeline.executors import BatchExecutor, CANCELLED_EXIT_CODE
+from singularity_pipeline.logs import StepOutput
+from singularity_pipeline.steps import parse_steps
+
+FAKE_SBATCH = """#!/bin/sh
+# Runs the job script in the background, honoring #SBATCH --output; the job id is its pid
+for last; do :; done
+log=$(sed -n 's/^#SBATCH --output=//p' "$last")
+nohup sh -c "sleep ${FAKE_QUEUE_DELAY:-0}; exec sh '$last'" > "${log:-/dev/null}" 2>&1 &
+echo "Submitted batch job $!"
+"""
+
+FAKE_SQUEUE = """#!/bin/sh
+while [ "$1" != "-j" ]; do shift; done
+kill -0 "$2" 2>/dev/null && echo RUNNING
+exit 0
+"""
+
+FAKE_SCANCEL = """#!/bin/sh
+# Records the cancelled job ids next to itself, then kills the job scripts
+echo "$@" >> "$(dirname "$0")/scancel.log"
+kill "$@" 2>/dev/null
+exit 0
+"""
+
+
+class BatchExecutorTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="executor-test-")
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(bin_dir)
+        self.cancelled_log = os.path.join(bin_dir, "scancel.log")
+        for name, script in [("sbatch", FAKE_SBATCH), ("squeue", FAKE_SQUEUE), ("scancel", FAKE_SCANCEL)]:
+            with open(os.path.join(bin_dir, name), "w") as f:
+                f.write(script)
+            os.chmod(os.path.join(bin_dir, name), 0o755)
+        self.path = os.environ["PATH"]
+        os.environ["PATH"] = bin_dir + os.pathsep + self.path
+        self.cwd = os.getcwd()
+        os.chdir(self.workdir)
+        self.cancel_event = threading.Event()
+        self.executor = BatchExecutor("slurm", os.path.join(self.workdir, "jobs"), poll_interval=0.1,
+                                      cancel_event=self.cancel_event)
+
+    def tearDown(self):
+        os.chdir(self.cwd)
+        os.environ["PATH"] = self.path
+        shutil.rmtree(self.workdir)
+
+    def test_exit_code_and_log(self):
+        step = parse_steps(["echo hello; exit 3"])[0]
+        with StepOutput() as output:
+            ret_code, measurements = self.executor.execute(step, "echo hello; exit 3", (1, 0), output)
+            self.assertEqual(ret_code, 3)
+            self.assertEqual(output.tail(), ["hello"])
+        self.assertTrue(measurements["job_id"])
+
+    def test_concurrent_variants(self):
+        step = parse_steps(["true"])[0]
+        results = {}
+
+        def run(variant):
+            command = "sleep 0.3; echo {0} > out-{0}.txt; exit {0}".format(variant)
+            results[variant] = self.executor.execute(step, command, (1, 0), variant=variant)[0]
+
+        threads = [threading.Thread(target=run, args=(str(index),)) for index in range(1, 5)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        self.assertEqual(results, {"1": 1, "2": 2, "3": 3, "4": 4})
+        for index in range(1, 5):
+            self.assertTrue(os.path.exists("out-{}.txt".format(index)))
+
+    def test_lost_job(self):
+        step = parse_steps(["true"])[0]
+        ret_code, measurements = self.executor.execute(step, "kill -9 $$", (1, 0))  # Kills the job script
+        self.assertEqual(ret_code, 1)
+        self.assertTrue(measurements["lost"])
+
+    def test_timeout_excludes_queue_time(self):
+        step = parse_steps(["true"])[0]
+        os.environ["FAKE_QUEUE_DELAY"] = "1"
+        try:
+            ret_code, measurements = self.executor.execute(step, "sleep 0.2", (1, 0), timeout=0.8)
+        finally:
+            del os.environ["FAKE_QUEUE_DELAY"]
+        self.assertEqual(ret_code, 0)
+        self.assertGreaterEqual(measurements["queue_time"], 0.9)
+
+    def test_timeout(self):
+        step = parse_steps(["true"])[0]
+        ret_code, measurements = self.executor.execute(step, "sleep 5", (1, 0), timeout=0.5)
+        self.assertEqual(ret_code, 124)
+        self.assertTrue(measurements["timed_out"])
+        self.assertEqual(len(self.cancelled_jobs()), 1)
+
+    def cancelled_jobs(self):
+        if not os.path.exists(self.cancelled_log):
+            return []
+        with open(self.cancelled_log) as f:
+            return f.read().split()
+
+    def test_cancel_event(self):
+        step = parse_steps(["sleep 5"])[0]
+        threading.Timer(0.5, self.cancel_event.set).start()
+        ret_code, measurements = self.executor.execute(step, "sleep 5", (1, 0))
+        self.assertEqual(ret_code, CANCELLED_EXIT_CODE)
+        self.assertTrue(measurements["cancelled"])
+        self.assertEqual(self.cancelled_jobs(), [measurements["job_id"]])
+
+    def test_interrupt_cancels_jobs(self):
+        steps = parse_steps([{"command": "sleep 5", "depends_on": []}, {"command": "sleep 5", "depends_on": []}])
+
+        def launch(step):
+            return self.executor.execute(step, step.command, (1, 0))[0]
+
+        timer = threading.Timer(0.5, os.kill, args=(os.getpid(), signal.SIGINT))  # As Ctrl-C
+        timer.start()
+        with self.assertRaises(KeyboardInterrupt):
+            self.executor.schedule(steps, launch)
+        timer.join()
+        self.assertEqual(len(self.cancelled_jobs()), 2)
+
+
+if __name__ == "__main__":
+    unittest.main()
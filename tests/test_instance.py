@@ -0,0 +1,93 @@
+"""Persistent instance tests against a stub `singularity` command."""
+
+import os
+import shutil
+import tempfile
+import unittest
+
+from singularity_pipeline.eprint import EPrint
+from singularity_pipeline.pipeline import Pipeline
+
+STUB_SINGULARITY = """#!/bin/sh
+# Logs invocations next to itself; runs exec payloads on the host
+echo "$*" >> "$(dirname "$0")/singularity.log"
+case "$1" in
+  --version) echo "2.4.2-stub" ;;
+  exec) shift 2; exec "$@" ;;
+esac
+exit 0
+"""
+
+DESCRIPTION = """
+name: Stub
+version: 1
+build: {{type: build, source: Singularity}}
+run:
+  commands: {commands}
+test:
+  test_files: []
+  validate_commands: ["true"]
+"""
+
+
+class PersistentInstanceTest(unittest.TestCase):
+
+    def setUp(self):
+        self.workdir = tempfile.mkdtemp(prefix="instance-test-")
+        bin_dir = os.path.join(self.workdir, "bin")
+        os.makedirs(bin_dir)
+        with open(os.path.join(bin_dir, "singularity"), "w") as f:
+            f.write(STUB_SINGULARITY)
+        os.chmod(os.path.join(bin_dir, "singularity"), 0o755)
+        self.log = os.path.join(bin_dir, "singularity.log")
+        self.environ = dict(os.environ)
+        os.environ["PATH"] = bin_dir + os.pathsep + os.environ["PATH"]
+        os.environ["XDG_CACHE_HOME"] = os.path.join(self.workdir, "cache")
+        self.image = os.path.join(self.workdir, "stub.img")
+        open(self.image, "w").close()
+
+    def tearDown(self):
+        os.environ.clear()
+        os.environ.update(self.environ)
+        shutil.rmtree(self.workdir)
+
+    def run_pipeline(self, commands):
+        pipeline = Pipeline(DESCRIPTION.format(commands=commands), imagefile=self.image,
+                            eprint_instance=EPrint(quiet=True), use_instance=True)
+        pipeline.run()
+
+    def calls(self):
+        with open(self.log) as f:
+            return [line.split() for line in f if not line.startswith("--version")]
+
+    def check_instance(self):
+        """Check the instance was started once and stopped, and return its name."""
+        calls = self.calls()
+        starts = [call for call in calls if call[0] == "instance.start"]
+        self.assertEqual(len(starts), 1)
+        name = starts[0][-1]
+        self.assertEqual(calls[0], starts[0])
+        self.assertEqual(calls[-1], ["instance.stop", name])
+        return name
+
+    def test_steps_use_instance(self):
+        self.run_pipeline('["{exec} true", "{run} true", "{exec} true"]')
+        name = self.check_instance()
+        steps = self.calls()[1:-1]
+        self.assertEqual([call[:2] for call in steps], [
+            ["exec", "instance://" + name], ["run", "instance://" + name], ["exec", "instance://" + name]
+        ])
+
+    def test_stopped_on_failure(self):
+        with self.assertRaises(RuntimeError):
+            self.run_pipeline('["{exec} false"]')
+        self.check_instance()
+
+    def test_stopped_on_interrupt(self):
+        with self.assertRaises(KeyboardInterrupt):
+            self.run_pipeline('["kill -INT $PPID; sleep 1"]')  # As Ctrl-C
+        self.check_instance()
+
+
+if __name__ == "__main__":
+    unittest.main()